@@ -22,24 +22,46 @@ import os
 import json
 import math
 import random
+import signal
+import subprocess
+import sys
+import asyncio
+import functools
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, time
+from time import monotonic
 from zoneinfo import ZoneInfo
+import httpx
+import numpy as np
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 
+import tornado.web
+from tornado.httpserver import HTTPServer
+
 from telegram import (
+    Bot,
     Update,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
 
@@ -66,6 +88,7 @@ SERVICIOS = {
         "canal_id": -1002697357566,
         "link":    "https://t.me/+Drczf-TdHCUzNDZh",
         "prefijo": "SE",
+        "capacidad": 1,   # servicios en curso simultáneos por móvil
     },
     "domicilios": {
         "nombre":  "Domicilios",
@@ -73,6 +96,7 @@ SERVICIOS = {
         "canal_id": -1002503403579,
         "link":    "https://t.me/+gZvnu8zolb1iOTBh",
         "prefijo": "D",
+        "capacidad": 2,
     },
     "camionetas": {
         "nombre":  "Camionetas",
@@ -80,6 +104,7 @@ SERVICIOS = {
         "canal_id": -1002662309590,
         "link":    "https://t.me/+KRam-XSvPQ5jNjRh",
         "prefijo": "C",
+        "capacidad": 1,
     },
     "motocarro": {
         "nombre":  "Motocarros",
@@ -87,6 +112,7 @@ SERVICIOS = {
         "canal_id": -1002688723492,
         "link":    "https://t.me/+REkbglMlfxE3YjI5",
         "prefijo": "M",
+        "capacidad": 1,
     },
 }
 
@@ -153,6 +179,12 @@ def get_prefijo(clave: str) -> str:
     return srv["prefijo"] if srv else "X"
 
 
+def get_capacidad(clave: str) -> int:
+    """Cuántos servicios reservados a la vez puede llevar un móvil de este servicio."""
+    srv = SERVICIOS.get(clave)
+    return int(srv.get("capacidad", 1)) if srv else 1
+
+
 # Canal de backups
 BACKUP_CHANNEL_ID = int(os.getenv("BACKUP_CHANNEL_ID", "0"))
 
@@ -168,17 +200,200 @@ if not DATABASE_URL:
     raise RuntimeError("La variable de entorno DATABASE_URL no está configurada.")
 
 
+# Pool de conexiones (configurable por entorno)
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT    = float(os.getenv("DB_POOL_TIMEOUT", "10"))     # segundos esperando una conexión libre
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))  # ping si la conexión estuvo inactiva más de N s
+
+
+class PoolAgotado(Exception):
+    """No se liberó ninguna conexión dentro de DB_POOL_TIMEOUT."""
+
+
+class PoolConexiones:
+    """
+    Pool acotado de conexiones PostgreSQL compartido por todos los helpers de datos.
+    - Mantiene como máximo `maximo` conexiones abiertas; si no hay libres, espera.
+    - Verifica la conexión al prestarla (SELECT 1 si estuvo inactiva) y la reemplaza si está rota.
+    - Si una conexión falla por error de red, descarta también las libres: tras un reinicio
+      de PostgreSQL todas quedan muertas y se reconecta al siguiente uso.
+    - Lleva estadísticas (en uso, en espera, latencia de préstamo) para monitoreo.
+    """
+
+    def __init__(self, dsn: str, minimo: int, maximo: int, timeout: float, check_idle: float):
+        self._dsn        = dsn
+        self._minimo     = max(0, minimo)
+        self._maximo     = max(1, maximo, self._minimo)
+        self._timeout    = timeout
+        self._check_idle = check_idle
+        self._cond       = threading.Condition()
+        self._libres: list[tuple] = []   # (conn, instante en que se devolvió)
+        self._en_uso     = 0
+        self._esperando  = 0
+        # Estadísticas
+        self._prestamos      = 0
+        self._latencia_total = 0.0
+        self._latencia_max   = 0.0
+        self._reconexiones   = 0
+        self._timeouts       = 0
+
+    def _conectar(self):
+        conn = psycopg2.connect(self._dsn)
+        conn.autocommit = True
+        return conn
+
+    @staticmethod
+    def _cerrar(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _sana(self, conn, inactiva: float) -> bool:
+        if conn.closed:
+            return False
+        if inactiva < self._check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def abrir(self):
+        """Precalienta el pool con `minimo` conexiones."""
+        nuevas = []
+        with self._cond:
+            faltan = self._minimo - (len(self._libres) + self._en_uso)
+        for _ in range(max(0, faltan)):
+            nuevas.append((self._conectar(), monotonic()))
+        with self._cond:
+            self._libres.extend(nuevas)
+            self._cond.notify_all()
+
+    def prestar(self):
+        """Toma una conexión sana del pool (espera hasta DB_POOL_TIMEOUT si está lleno)."""
+        inicio = monotonic()
+        limite = inicio + self._timeout
+        conn, devuelta = None, 0.0
+        with self._cond:
+            self._esperando += 1
+            try:
+                while True:
+                    if self._libres:
+                        conn, devuelta = self._libres.pop()
+                        break
+                    if self._en_uso + len(self._libres) < self._maximo:
+                        break
+                    restante = limite - monotonic()
+                    if restante <= 0:
+                        self._timeouts += 1
+                        raise PoolAgotado(f"Sin conexiones libres tras {self._timeout:g}s")
+                    self._cond.wait(restante)
+                self._en_uso += 1
+            finally:
+                self._esperando -= 1
+
+        try:
+            if conn is not None and not self._sana(conn, monotonic() - devuelta):
+                self._cerrar(conn)
+                conn = None
+                with self._cond:
+                    self._reconexiones += 1
+            if conn is None:
+                conn = self._conectar()
+        except Exception:
+            with self._cond:
+                self._en_uso -= 1
+                self._cond.notify()
+            raise
+
+        latencia = monotonic() - inicio
+        with self._cond:
+            self._prestamos      += 1
+            self._latencia_total += latencia
+            self._latencia_max    = max(self._latencia_max, latencia)
+        return conn
+
+    def devolver(self, conn, rota: bool = False):
+        """Devuelve una conexión. Si está rota se cierra junto con las libres (posible reinicio de BD)."""
+        descartadas = []
+        if rota or conn.closed:
+            descartadas.append(conn)
+        elif conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                descartadas.append(conn)
+        with self._cond:
+            self._en_uso -= 1
+            if descartadas:
+                if rota:
+                    descartadas.extend(c for c, _ in self._libres)
+                    self._libres.clear()
+            else:
+                self._libres.append((conn, monotonic()))
+            self._cond.notify_all()
+        for c in descartadas:
+            self._cerrar(c)
+
+    def cerrar_todo(self):
+        with self._cond:
+            libres = [c for c, _ in self._libres]
+            self._libres.clear()
+        for c in libres:
+            self._cerrar(c)
+
+    def stats(self) -> dict:
+        """Estadísticas del pool para monitoreo."""
+        with self._cond:
+            return {
+                "en_uso":          self._en_uso,
+                "libres":          len(self._libres),
+                "esperando":       self._esperando,
+                "maximo":          self._maximo,
+                "prestamos":       self._prestamos,
+                "latencia_media_ms": (self._latencia_total / self._prestamos * 1000) if self._prestamos else 0.0,
+                "latencia_max_ms": self._latencia_max * 1000,
+                "reconexiones":    self._reconexiones,
+                "timeouts":        self._timeouts,
+            }
+
+
+DB_POOL = PoolConexiones(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
+
+
+@contextmanager
 def get_db():
-    """Abre una conexión nueva a PostgreSQL. Ciérrala al terminar."""
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True
-    return conn
+    """Presta una conexión del pool (autocommit) y la devuelve al salir del bloque `with`."""
+    conn = DB_POOL.prestar()
+    rota = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        rota = True
+        raise
+    finally:
+        DB_POOL.devolver(conn, rota=rota)
 
 
 def init_db():
     """Crea las tablas si no existen."""
-    conn = get_db()
-    cur = conn.cursor()
+    with get_db() as conn, conn.cursor() as cur:
+        # Con varios workers arrancando a la vez, las migraciones se hacen de a una.
+        # Candado de sesión: la conexión es autocommit, uno de transacción no duraría nada.
+        cur.execute("SELECT pg_advisory_lock(hashtext('pronto:init_db'))")
+        try:
+            _crear_tablas(cur)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(hashtext('pronto:init_db'))")
+    print("[DB] Tablas verificadas correctamente.")
+
+
+def _crear_tablas(cur):
+    """Tablas, migraciones e índices (idempotente)."""
     cur.execute("""
         CREATE TABLE IF NOT EXISTS mobiles (
             user_id TEXT PRIMARY KEY,
@@ -201,14 +416,223 @@ def init_db():
             data JSONB
         )
     """)
-    cur.close()
-    conn.close()
-    print("[DB] Tablas verificadas correctamente.")
+    _migrar_columnas_servicios(cur)
+    # Histórico: servicios terminados ya archivados (misma estructura que services)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS services_archivo (
+            LIKE services INCLUDING DEFAULTS,
+            PRIMARY KEY (service_id)
+        )
+    """)
+    _migrar_columnas_servicios(cur, "services_archivo")
+    # Estado de conversación por usuario (context.user_data), ver PersistenciaPostgres
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS estado_usuarios (
+            user_id     BIGINT PRIMARY KEY,
+            datos       JSONB NOT NULL,
+            actualizado TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS services_archivo_creado_idx ON services_archivo (creado_en)")
+    # IDs de servicio (S00001...) desde una secuencia: atómica y O(1).
+    # Migración: si ya hay servicios, la secuencia arranca después del mayor ID existente.
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS services_id_seq")
+    cur.execute("""
+        SELECT setval('services_id_seq', t.maximo)
+        FROM (
+            SELECT MAX(substring(service_id FROM 2)::bigint) AS maximo
+            FROM (SELECT service_id FROM services UNION ALL SELECT service_id FROM services_archivo) ids
+            WHERE service_id ~ '^S[0-9]+$'
+        ) t
+        WHERE t.maximo IS NOT NULL
+          AND t.maximo >= (
+              SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END
+              FROM services_id_seq
+          )
+    """)
+    # Códigos de móvil (D001, SE007...): un contador atómico por prefijo.
+    # Migración: cada contador arranca en el mayor número ya usado con ese prefijo.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS codigo_contadores (
+            prefijo TEXT PRIMARY KEY,
+            ultimo  INTEGER NOT NULL
+        )
+    """)
+    for prefijo in {info["prefijo"] for info in SERVICIOS.values()}:
+        cur.execute("""
+            INSERT INTO codigo_contadores (prefijo, ultimo)
+            SELECT %s, COALESCE(MAX(substring(codigo FROM %s)::int), 0)
+            FROM mobiles
+            WHERE codigo ~ %s
+            ON CONFLICT (prefijo) DO UPDATE
+                SET ultimo = GREATEST(codigo_contadores.ultimo, EXCLUDED.ultimo)
+        """, (prefijo, len(prefijo) + 1, f"^{prefijo}[0-9]+$"))
+    try:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS mobiles_codigo_key ON mobiles (codigo)")
+    except psycopg2.errors.UniqueViolation:
+        print("[DB] ⚠️ Hay códigos de móvil repetidos; corrígelos para activar la restricción única.")
+    # Índices parciales sobre las columnas (los de expresiones JSONB quedaron obsoletos)
+    cur.execute("DROP INDEX IF EXISTS services_reservado_movil_idx")
+    cur.execute("DROP INDEX IF EXISTS services_en_espera_idx")
+    # Servicios vivos por estado y tipo (panel de admin, despacho)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS services_activos_idx
+        ON services (status, servicio, creado_en)
+        WHERE status IN ('en_espera', 'pendiente', 'reservado')
+    """)
+    # Carga de cada móvil (servicios reservados en curso) para el despacho
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS services_carga_movil_idx
+        ON services (movil_chat_id)
+        WHERE status = 'reservado'
+    """)
+    # Terminados pendientes de archivar, por antigüedad
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS services_terminados_idx
+        ON services ((COALESCE(completado_en, creado_en)))
+        WHERE status IN ('completado', 'expirado')
+    """)
+    # Cola de espera: solicitudes sin móvil disponible, por servicio y antigüedad
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS services_cola_idx
+        ON services (servicio, ((data->>'en_espera_ts')::float8))
+        WHERE status = 'en_espera'
+    """)
+
+
+# Campos del servicio con columna propia en la tabla services (nombre → tipo SQL).
+# El resto de datos (nombre, teléfono, destino, ofertas, ...) sigue en el JSONB `data`.
+SERVICIO_COLUMNAS = {
+    "status":        "TEXT",
+    "servicio":      "TEXT",
+    "movil_codigo":  "TEXT",
+    "movil_chat_id": "BIGINT",
+    "user_chat_id":  "BIGINT",
+    "lat":           "DOUBLE PRECISION",
+    "lon":           "DOUBLE PRECISION",
+}
+# Marcas de tiempo que pone la BD (solo lectura desde Python)
+SERVICIO_MARCAS = ("creado_en", "reservado_en", "completado_en")
+
+# Estados que cuentan como "vivos" (aún no terminan) y los que ya no cambian
+ESTADOS_ACTIVOS    = ("en_espera", "pendiente", "reservado")
+ESTADOS_TERMINALES = ("completado", "expirado")
+
+
+def _migrar_columnas_servicios(cur, tabla: str = "services"):
+    """
+    Migración del JSONB a columnas: agrega las columnas que falten y mueve a ellas los
+    valores que todavía estén dentro de `data` (normalizando nombres viejos de servicio
+    con NOMBRE_A_CLAVE). Idempotente: solo toca filas que aún tienen esas llaves.
+    """
+    for columna, tipo in SERVICIO_COLUMNAS.items():
+        cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS {columna} {tipo}")
+    cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS creado_en TIMESTAMPTZ DEFAULT now()")
+    cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS reservado_en TIMESTAMPTZ")
+    cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS completado_en TIMESTAMPTZ")
+
+    llaves  = list(SERVICIO_COLUMNAS)
+    nombres = {**NOMBRE_A_CLAVE, **{clave: clave for clave in SERVICIOS}}
+    cur.execute(rf"""
+        WITH nombres AS (
+            SELECT * FROM unnest(%s::text[], %s::text[]) AS n(nombre, clave)
+        )
+        UPDATE {tabla} s SET
+            status        = CASE WHEN data ? 'status' THEN data->>'status' ELSE status END,
+            servicio      = CASE WHEN data ? 'servicio'
+                                 THEN COALESCE((SELECT clave FROM nombres WHERE nombre = data->>'servicio'),
+                                               data->>'servicio')
+                                 ELSE servicio END,
+            movil_codigo  = CASE WHEN data ? 'movil_codigo' THEN data->>'movil_codigo' ELSE movil_codigo END,
+            movil_chat_id = CASE WHEN data->>'movil_chat_id' ~ '^-?[0-9]+$'
+                                 THEN (data->>'movil_chat_id')::bigint
+                                 WHEN data ? 'movil_chat_id' THEN NULL ELSE movil_chat_id END,
+            user_chat_id  = CASE WHEN data->>'user_chat_id' ~ '^-?[0-9]+$'
+                                 THEN (data->>'user_chat_id')::bigint
+                                 WHEN data ? 'user_chat_id' THEN NULL ELSE user_chat_id END,
+            lat           = CASE WHEN jsonb_typeof(data->'lat') = 'number' THEN (data->>'lat')::float8
+                                 WHEN data ? 'lat' THEN NULL ELSE lat END,
+            lon           = CASE WHEN jsonb_typeof(data->'lon') = 'number' THEN (data->>'lon')::float8
+                                 WHEN data ? 'lon' THEN NULL ELSE lon END,
+            creado_en     = CASE WHEN data->>'hora' ~ '^\d{{4}}-\d{{2}}-\d{{2}} \d{{2}}:\d{{2}} [AP]M$'
+                                 THEN to_timestamp(data->>'hora', 'YYYY-MM-DD HH12:MI AM')::timestamp
+                                      AT TIME ZONE 'America/Bogota'
+                                 ELSE creado_en END,
+            reservado_en  = CASE WHEN data->>'hora_reserva' ~ '^\d{{4}}-\d{{2}}-\d{{2}} \d{{2}}:\d{{2}} [AP]M$'
+                                 THEN to_timestamp(data->>'hora_reserva', 'YYYY-MM-DD HH12:MI AM')::timestamp
+                                      AT TIME ZONE 'America/Bogota'
+                                 ELSE reservado_en END,
+            data          = data - %s::text[]
+        WHERE data ?| %s::text[]
+    """, (list(nombres), list(nombres.values()), llaves, llaves))
+    if cur.rowcount:
+        print(f"[DB] Migración de {tabla} a columnas: {cur.rowcount} registros.")
+
+    # Pendientes de antes de `oferta_vence`: su único móvil los ignoró y nadie los movió.
+    # Los que ya superan COLA_EXPIRA_MIN se expiran (el cliente se dio por vencido); los
+    # recientes quedan con la ronda vencida, sin el móvil viejo, para que revisar_cola los
+    # pase a otros móviles.
+    cur.execute(f"""
+        UPDATE {tabla} SET status = 'expirado'
+        WHERE status = 'pendiente' AND NOT data ? 'oferta_vence'
+          AND COALESCE(creado_en, '-infinity') < now() - make_interval(secs => %s)
+    """, (COLA_EXPIRA_MIN * 60,))
+    expirados = cur.rowcount
+    cur.execute(f"""
+        UPDATE {tabla} SET
+            data = data || jsonb_build_object(
+                'oferta_vence', 0,
+                'descartados', COALESCE(data->'descartados', '[]'::jsonb)
+                               || CASE WHEN movil_chat_id IS NULL THEN '[]'::jsonb
+                                       ELSE jsonb_build_array(movil_chat_id::text) END
+            ),
+            movil_chat_id = NULL,
+            movil_codigo  = NULL
+        WHERE status = 'pendiente' AND NOT data ? 'oferta_vence'
+    """)
+    if expirados or cur.rowcount:
+        print(f"[DB] Pendientes sin vencimiento en {tabla}: {expirados} expirados, {cur.rowcount} a reofertar.")
+
+
+# Expresión que reconstruye el dict completo del servicio (payload JSONB + columnas)
+_SERVICIO_SQL = "(data || jsonb_build_object({}))".format(
+    ", ".join(f"'{c}', {c}" for c in (*SERVICIO_COLUMNAS, *SERVICIO_MARCAS))
+)
 
 # Webhook Railway
-WEBHOOK_DOMAIN = "https://pronto-empty-production.up.railway.app"
-WEBHOOK_PATH   = f"/webhook/{TOKEN}"
-WEBHOOK_URL    = WEBHOOK_DOMAIN + WEBHOOK_PATH
+# BOT_MODE=webhook recibe los updates por HTTP (run_webhook); cualquier otro valor usa
+# long polling, el modo del proceso `worker:` del Procfile. El proceso `web:` arranca
+# BOT_MODE=cluster en PORT (escalar uno de los dos, no ambos). TELEGRAM_API_URL permite
+# apuntar el bot a un servidor falso para pruebas locales (ej: http://127.0.0.1:8081/bot);
+# WEBHOOK_DOMAIN=http://127.0.0.1:8443 en ese caso.
+BOT_MODE         = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_DOMAIN   = os.getenv("WEBHOOK_DOMAIN", "https://pronto-empty-production.up.railway.app").rstrip("/")
+WEBHOOK_PATH     = f"/webhook/{TOKEN}"
+WEBHOOK_URL      = WEBHOOK_DOMAIN + WEBHOOK_PATH
+WEBHOOK_LISTEN   = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT     = int(os.getenv("PORT", "8443"))                    # Railway inyecta PORT
+WEBHOOK_SECRET   = os.getenv("WEBHOOK_SECRET") or None               # cabecera X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONN = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))   # conexiones simultáneas desde Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL") or None
+
+# Varios workers (BOT_MODE=cluster | router | worker)
+# - cluster: este proceso recibe el webhook de Telegram y lanza WORKERS procesos hijos.
+# - router:  solo recibe el webhook y reenvía a WORKER_URLS (workers en otras máquinas).
+# - worker:  atiende los updates reenviados en PORT (/update), sin tocar el webhook. Con
+#            router cada worker remoto necesita WORKER_INDICE (único; solo el 0 corre las
+#            tareas de mantenimiento) y WORKERS (el total).
+# Cada update va siempre al mismo worker según su chat_id (chat_id mod WORKERS).
+# Prueba local (API de Telegram falsa + PostgreSQL de pruebas): prueba_cluster.py
+WORKERS_TOTAL       = int(os.getenv("WORKERS", "1"))
+WORKER_INDICE       = int(os.getenv("WORKER_INDICE", "0"))
+WORKERS_PUERTO_BASE = int(os.getenv("WORKERS_PUERTO_BASE", "9100"))
+WORKER_URLS         = [u.strip().rstrip("/") for u in os.getenv("WORKER_URLS", "").split(",") if u.strip()]
+WORKER_SECRET       = os.getenv("WORKER_SECRET") or WEBHOOK_SECRET   # cabecera X-Pronto-Worker-Secret
+WORKER_TIMEOUT_S    = float(os.getenv("WORKER_TIMEOUT_S", "10"))     # reenvío router → worker
+
+# Estado de conversación (context.user_data) en PostgreSQL, compartido entre workers y reinicios
+ESTADO_COMPARTIDO   = os.getenv("ESTADO_COMPARTIDO", "1") == "1"
+ESTADO_INTERVALO_S  = float(os.getenv("ESTADO_INTERVALO_S", "1"))    # cada cuánto se guardan los cambios
 
 # Zona horaria Colombia
 TZ_CO = ZoneInfo("America/Bogota")
@@ -240,106 +664,773 @@ async def deny_admin_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Base de datos ---
 
+# Columnas editables de la tabla mobiles (todas salvo la clave user_id)
+MOBILE_CAMPOS = (
+    "codigo", "servicio", "lat", "lon", "activo", "nombre",
+    "cedula", "placa", "marca", "modelo", "pago_aprobado",
+)
+
+
+def _mobile_desde_fila(row) -> dict:
+    """Convierte una fila de mobiles (RealDictCursor) al dict de datos del móvil."""
+    return {campo: row[campo] for campo in MOBILE_CAMPOS}
+
+
+# --- Avisos de cambios entre procesos (LISTEN/NOTIFY) ---
+#
+# Cada escritura de mobiles / services emite un NOTIFY en CAMBIOS_CANAL con las claves
+# tocadas; los demás procesos que comparten la BD lo escuchan (OyenteCambios) y
+# refrescan sus cachés locales. El propio proceso ignora sus avisos (PROCESO_ID).
+
+CAMBIOS_CANAL  = "pronto_cambios"
+CAMBIOS_NOTIFY = os.getenv("CAMBIOS_NOTIFY", "1") == "1"
+PROCESO_ID     = uuid.uuid4().hex[:12]
+_NOTIFY_MAX    = 7500   # bytes; Postgres admite hasta 8000 por aviso
+
+
+def _notificar(cur, tabla: str, ids=None):
+    """Emite el aviso de cambio (ids=None significa "todo cambió")."""
+    if not CAMBIOS_NOTIFY:
+        return
+    payload = json.dumps({"o": PROCESO_ID, "t": tabla, "ids": None if ids is None else [str(i) for i in ids]})
+    if len(payload.encode()) > _NOTIFY_MAX:
+        payload = json.dumps({"o": PROCESO_ID, "t": tabla, "ids": None})
+    cur.execute("SELECT pg_notify(%s, %s)", (CAMBIOS_CANAL, payload))
+
+
+# --- Caché de móviles (write-through) ---
+#
+# La tabla mobiles se lee completa una vez y queda en memoria, con índice por user_id y
+# por código. Toda escritura de este proceso (save_mobile, update_mobile, delete_mobile,
+# save_mobiles) actualiza la caché en el mismo paso; la BD solo se vuelve a leer ante un
+# fallo de caché, una invalidación o cuando vence MOVILES_CACHE_TTL_S (red de seguridad).
+# La recarga completa (caché + INDICE_FLOTA, que es lo que lee el despacho) la hace un job
+# cada MOVILES_CACHE_TTL_S, y también cualquier lectura que encuentre la caché vencida.
+
+MOVILES_CACHE_TTL_S = float(os.getenv("MOVILES_CACHE_TTL_S", "300"))
+
+
+class CacheMoviles:
+    """Móviles en memoria: {user_id: datos} + índice {CÓDIGO: user_id}. Entrega copias."""
+
+    def __init__(self, ttl_s: float):
+        self._ttl     = ttl_s
+        self._lock    = threading.Lock()
+        self._moviles: dict[str, dict] = {}
+        self._codigos: dict[str, str]  = {}
+        self._cargado = None   # monotonic() de la última carga completa; None = sin cargar
+        self.metricas = {"aciertos": 0, "fallos": 0, "recargas": 0}
+
+    def _vigente(self) -> bool:
+        return self._cargado is not None and monotonic() - self._cargado < self._ttl
+
+    def vencida(self) -> bool:
+        with self._lock:
+            return not self._vigente()
+
+    def cargar(self, mobiles: dict):
+        with self._lock:
+            self._moviles = {uid: dict(m) for uid, m in mobiles.items()}
+            self._codigos = {(m.get("codigo") or "").upper(): uid for uid, m in mobiles.items() if m.get("codigo")}
+            self._cargado = monotonic()
+            self.metricas["recargas"] += 1
+
+    def invalidar(self, user_id: str | None = None):
+        """Sin argumento invalida todo (la próxima lectura recarga); con user_id, solo ese móvil."""
+        with self._lock:
+            if user_id is None:
+                self._cargado = None
+            else:
+                self._quitar(str(user_id))
+
+    def todos(self) -> dict | None:
+        with self._lock:
+            if not self._vigente():
+                return None
+            self.metricas["aciertos"] += 1
+            return {uid: dict(m) for uid, m in self._moviles.items()}
+
+    def obtener(self, user_id: str) -> dict | None:
+        with self._lock:
+            m = self._moviles.get(str(user_id)) if self._vigente() else None
+            self.metricas["aciertos" if m else "fallos"] += 1
+            return dict(m) if m else None
+
+    def por_codigo(self, codigo: str) -> tuple[str, dict] | None:
+        with self._lock:
+            uid = self._codigos.get((codigo or "").upper()) if self._vigente() else None
+            self.metricas["aciertos" if uid else "fallos"] += 1
+            return (uid, dict(self._moviles[uid])) if uid else None
+
+    def poner(self, user_id: str, m: dict):
+        with self._lock:
+            self._quitar(str(user_id))
+            self._moviles[str(user_id)] = dict(m)
+            if m.get("codigo"):
+                self._codigos[m["codigo"].upper()] = str(user_id)
+
+    def quitar(self, user_id: str):
+        with self._lock:
+            self._quitar(str(user_id))
+
+    def _quitar(self, user_id: str):
+        anterior = self._moviles.pop(user_id, None)
+        if anterior and anterior.get("codigo"):
+            self._codigos.pop(anterior["codigo"].upper(), None)
+
+
+CACHE_MOVILES = CacheMoviles(MOVILES_CACHE_TTL_S)
+
+
+def _leer_mobiles() -> dict:
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("SELECT * FROM mobiles")
+        rows = cur.fetchall()
+    return {row["user_id"]: _mobile_desde_fila(row) for row in rows}
+
+
+_RECARGA_MOVILES = threading.RLock()
+
+
+def recargar_mobiles() -> dict:
+    """Relee la tabla mobiles y reconstruye la caché y el índice espacial."""
+    with _RECARGA_MOVILES:
+        mobiles = _leer_mobiles()
+        CACHE_MOVILES.cargar(mobiles)
+        INDICE_FLOTA.cargar(mobiles)
+    return mobiles
+
+
+def _renovar_cache_mobiles():
+    """Si la caché venció, la recarga completa (una sola vez aunque lleguen varias lecturas)."""
+    if not CACHE_MOVILES.vencida() or not _RECARGA_MOVILES.acquire(blocking=False):
+        return   # vigente, o ya la está recargando otro hilo (mientras, se lee fila por fila)
+    try:
+        if CACHE_MOVILES.vencida():
+            recargar_mobiles()
+    finally:
+        _RECARGA_MOVILES.release()
+
+
 def get_mobiles() -> dict:
-    """Lee todos los móviles desde PostgreSQL y los retorna como dict {user_id: datos}."""
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM mobiles")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    result = {}
-    for row in rows:
-        uid = row["user_id"]
-        result[uid] = {
-            "codigo":        row["codigo"],
-            "servicio":      row["servicio"],
-            "lat":           row["lat"],
-            "lon":           row["lon"],
-            "activo":        row["activo"],
-            "nombre":        row["nombre"],
-            "cedula":        row["cedula"],
-            "placa":         row["placa"],
-            "marca":         row["marca"],
-            "modelo":        row["modelo"],
-            "pago_aprobado": row["pago_aprobado"],
-        }
-    return result
+    """Todos los móviles como dict {user_id: datos} (desde la caché; recarga si venció)."""
+    mobiles = CACHE_MOVILES.todos()
+    return mobiles if mobiles is not None else recargar_mobiles()
+
+
+def refrescar_mobiles(user_ids) -> None:
+    """Relee de la BD solo los móviles indicados (aviso de otro proceso) y actualiza caché e índice."""
+    ids = [str(u) for u in user_ids]
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("SELECT * FROM mobiles WHERE user_id = ANY(%s)", (ids,))
+        filas = {row["user_id"]: _mobile_desde_fila(row) for row in cur.fetchall()}
+    for uid in ids:
+        if uid in filas:
+            CACHE_MOVILES.poner(uid, filas[uid])
+            INDICE_FLOTA.actualizar(uid, filas[uid])
+        else:
+            CACHE_MOVILES.quitar(uid)
+            INDICE_FLOTA.quitar(uid)
+
+
+def _leer_mobile(where: str, valor) -> tuple[str, dict] | None:
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(f"SELECT * FROM mobiles WHERE {where}", (valor,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    m = _mobile_desde_fila(row)
+    CACHE_MOVILES.poner(row["user_id"], m)
+    return row["user_id"], m
+
+
+def get_mobile(user_id: str) -> dict | None:
+    """Un móvil por user_id: caché primero, BD solo si no está."""
+    _renovar_cache_mobiles()
+    m = CACHE_MOVILES.obtener(user_id)
+    if m is not None:
+        return m
+    encontrado = _leer_mobile("user_id = %s", str(user_id))
+    return encontrado[1] if encontrado else None
+
+
+def get_mobile_por_codigo(codigo: str) -> tuple[str, dict] | None:
+    """(user_id, datos) del móvil con ese código (sin distinguir mayúsculas), o None."""
+    _renovar_cache_mobiles()
+    encontrado = CACHE_MOVILES.por_codigo(codigo)
+    if encontrado is not None:
+        return encontrado
+    return _leer_mobile("upper(codigo) = upper(%s)", codigo)
+
+
+_UPSERT_MOBILE_SQL = """
+    INSERT INTO mobiles (user_id, codigo, servicio, lat, lon, activo, nombre, cedula, placa, marca, modelo, pago_aprobado)
+    VALUES %s
+    ON CONFLICT (user_id) DO UPDATE SET
+        codigo        = EXCLUDED.codigo,
+        servicio      = EXCLUDED.servicio,
+        lat           = EXCLUDED.lat,
+        lon           = EXCLUDED.lon,
+        activo        = EXCLUDED.activo,
+        nombre        = EXCLUDED.nombre,
+        cedula        = EXCLUDED.cedula,
+        placa         = EXCLUDED.placa,
+        marca         = EXCLUDED.marca,
+        modelo        = EXCLUDED.modelo,
+        pago_aprobado = EXCLUDED.pago_aprobado
+"""
+
+
+def _fila_mobile(user_id: str, m: dict) -> tuple:
+    return (
+        user_id,
+        m.get("codigo"),
+        m.get("servicio"),
+        m.get("lat"),
+        m.get("lon"),
+        m.get("activo", True),
+        m.get("nombre"),
+        m.get("cedula"),
+        m.get("placa"),
+        m.get("marca"),
+        m.get("modelo"),
+        m.get("pago_aprobado", False),
+    )
 
 
 def save_mobiles(data: dict):
-    """Guarda el dict completo de móviles en PostgreSQL (upsert por user_id)."""
-    conn = get_db()
-    cur = conn.cursor()
-    for user_id, m in data.items():
-        cur.execute("""
-            INSERT INTO mobiles (user_id, codigo, servicio, lat, lon, activo, nombre, cedula, placa, marca, modelo, pago_aprobado)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-                codigo        = EXCLUDED.codigo,
-                servicio      = EXCLUDED.servicio,
-                lat           = EXCLUDED.lat,
-                lon           = EXCLUDED.lon,
-                activo        = EXCLUDED.activo,
-                nombre        = EXCLUDED.nombre,
-                cedula        = EXCLUDED.cedula,
-                placa         = EXCLUDED.placa,
-                marca         = EXCLUDED.marca,
-                modelo        = EXCLUDED.modelo,
-                pago_aprobado = EXCLUDED.pago_aprobado
-        """, (
-            user_id,
-            m.get("codigo"),
-            m.get("servicio"),
-            m.get("lat"),
-            m.get("lon"),
-            m.get("activo", True),
-            m.get("nombre"),
-            m.get("cedula"),
-            m.get("placa"),
-            m.get("marca"),
-            m.get("modelo"),
-            m.get("pago_aprobado", False),
-        ))
-    cur.close()
-    conn.close()
+    """
+    Guarda el dict completo de móviles en PostgreSQL (upsert por user_id).
+    Solo para importaciones masivas: los handlers usan save_mobile / update_mobile.
+    """
+    if not data:
+        return
+    with get_db() as conn, conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur, _UPSERT_MOBILE_SQL, [_fila_mobile(uid, m) for uid, m in data.items()]
+        )
+        _notificar(cur, "mobiles", data.keys())
+    recargar_mobiles()
+
+
+def save_mobile(user_id: str, m: dict):
+    """Inserta o reemplaza el registro completo de UN móvil (ej: al registrarlo)."""
+    with get_db() as conn, conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, _UPSERT_MOBILE_SQL, [_fila_mobile(user_id, m)])
+        _notificar(cur, "mobiles", [user_id])
+    m = dict(zip(MOBILE_CAMPOS, _fila_mobile(user_id, m)[1:]))
+    CACHE_MOVILES.poner(user_id, m)
+    INDICE_FLOTA.actualizar(user_id, m)
+
+
+def update_mobile(user_id: str, **campos) -> bool:
+    """
+    Actualiza solo los campos indicados de un móvil (ej: update_mobile(uid, lat=.., lon=..)).
+    No toca el resto de columnas, así dos escrituras concurrentes sobre campos
+    distintos no se pisan. Retorna False si el móvil no existe.
+    """
+    desconocidos = set(campos) - set(MOBILE_CAMPOS)
+    if desconocidos:
+        raise ValueError(f"Campos de móvil desconocidos: {', '.join(sorted(desconocidos))}")
+    if not campos:
+        return True
+    asignaciones = ", ".join(f"{c} = %s" for c in campos)
+    with get_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            f"UPDATE mobiles SET {asignaciones} WHERE user_id = %s RETURNING *",
+            (*campos.values(), user_id),
+        )
+        row = cur.fetchone()
+        if row:
+            _notificar(cur, "mobiles", [user_id])
+    if not row:
+        CACHE_MOVILES.quitar(user_id)
+        return False
+    m = _mobile_desde_fila(row)
+    CACHE_MOVILES.poner(user_id, m)
+    INDICE_FLOTA.actualizar(user_id, m)
+    return True
 
 
 def delete_mobile(user_id: str):
     """Elimina un móvil de PostgreSQL por su user_id."""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM mobiles WHERE user_id = %s", (user_id,))
-    cur.close()
-    conn.close()
-
-
-def get_services() -> dict:
-    """Lee todos los servicios desde PostgreSQL."""
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT service_id, data FROM services")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    result = {}
-    for row in rows:
-        result[row["service_id"]] = row["data"]
-    return result
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM mobiles WHERE user_id = %s", (user_id,))
+        _notificar(cur, "mobiles", [user_id])
+    CACHE_MOVILES.quitar(user_id)
+    INDICE_FLOTA.quitar(user_id)
+
+
+def _separar_servicio(campos: dict) -> tuple[dict, dict]:
+    """Divide los campos de un servicio en (columnas, payload JSONB). Las marcas de tiempo se ignoran."""
+    columnas = {c: campos[c] for c in SERVICIO_COLUMNAS if c in campos}
+    if columnas.get("servicio"):
+        columnas["servicio"] = normalizar_servicio(columnas["servicio"]) or columnas["servicio"]
+    payload = {k: v for k, v in campos.items() if k not in SERVICIO_COLUMNAS and k not in SERVICIO_MARCAS}
+    return columnas, payload
+
+
+def _fila_servicio(service_id: str, sdata: dict) -> tuple:
+    columnas, payload = _separar_servicio(sdata)
+    return (
+        service_id,
+        json.dumps(payload, ensure_ascii=False),
+        *(columnas.get(c) for c in SERVICIO_COLUMNAS),
+    )
+
+
+_UPSERT_SERVICE_SQL = """
+    INSERT INTO services (service_id, data, {cols})
+    VALUES %s
+    ON CONFLICT (service_id) DO UPDATE SET data = EXCLUDED.data, {sets}
+""".format(
+    cols=", ".join(SERVICIO_COLUMNAS),
+    sets=", ".join(f"{c} = EXCLUDED.{c}" for c in SERVICIO_COLUMNAS),
+)
+
+
+def get_services(incluir_archivo: bool = False) -> dict:
+    """Lee todos los servicios vivos desde PostgreSQL (y los archivados si se pide)."""
+    sql = f"SELECT service_id, {_SERVICIO_SQL} FROM services"
+    if incluir_archivo:
+        sql += f" UNION ALL SELECT service_id, {_SERVICIO_SQL} FROM services_archivo"
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(sql)
+        return dict(cur.fetchall())
+
+
+def servicios_activos() -> list[dict]:
+    """Servicios vivos (en espera, pendientes o reservados), del más antiguo al más nuevo."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {_SERVICIO_SQL} FROM services WHERE status = ANY(%s) ORDER BY creado_en",
+            (list(ESTADOS_ACTIVOS),),
+        )
+        return [row[0] for row in cur.fetchall()]
 
 
 def save_services(data: dict):
     """Guarda el dict completo de servicios en PostgreSQL (upsert)."""
-    conn = get_db()
-    cur = conn.cursor()
-    for service_id, sdata in data.items():
+    if not data:
+        return
+    with get_db() as conn, conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur, _UPSERT_SERVICE_SQL, [_fila_servicio(sid, sdata) for sid, sdata in data.items()]
+        )
+        _notificar(cur, "services", data.keys())
+
+
+def get_service(service_id: str, incluir_archivo: bool = False) -> dict | None:
+    """Lee UN servicio por su ID (None si no existe). Con incluir_archivo busca también en el histórico."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT {_SERVICIO_SQL} FROM services WHERE service_id = %s", (service_id,))
+        row = cur.fetchone()
+        if not row and incluir_archivo:
+            cur.execute(f"SELECT {_SERVICIO_SQL} FROM services_archivo WHERE service_id = %s", (service_id,))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+
+def create_service(sdata: dict) -> str:
+    """
+    Crea un servicio nuevo con ID tomado de la secuencia services_id_seq (formato S%05d).
+    El INSERT no pisa registros existentes: un choque de ID falla en vez de sobrescribir.
+    """
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT nextval('services_id_seq')")
+        service_id  = f"S{cur.fetchone()[0]:05d}"
+        sdata["id"] = service_id
+        cur.execute(
+            f"INSERT INTO services (service_id, data, {', '.join(SERVICIO_COLUMNAS)}) "
+            f"VALUES ({', '.join(['%s'] * (len(SERVICIO_COLUMNAS) + 2))})",
+            _fila_servicio(service_id, sdata),
+        )
+        _notificar(cur, "services", [service_id])
+    return service_id
+
+
+def update_service(service_id: str, si: dict | None = None, **campos) -> dict | None:
+    """
+    Actualiza de forma atómica solo los campos indicados de un servicio
+    (columnas + merge JSONB en una sola sentencia). Con `si` (ej: {"status": "pendiente", "ronda": 2})
+    solo actualiza si el servicio todavía contiene esos valores.
+    Retorna el servicio actualizado, o None si no existe o no cumplió la condición.
+    """
+    columnas, payload = _separar_servicio(campos)
+    sets   = [f"{c} = %s" for c in columnas] + ["data = data || %s::jsonb"]
+    params = [*columnas.values(), json.dumps(payload, ensure_ascii=False)]
+    if columnas.get("status") == "completado":
+        sets.append("completado_en = now()")
+
+    where = ["service_id = %s"]
+    params.append(service_id)
+    if si:
+        si_columnas, si_payload = _separar_servicio(si)
+        for c, v in si_columnas.items():
+            where.append(f"{c} IS NOT DISTINCT FROM %s")
+            params.append(v)
+        if si_payload:
+            where.append("data @> %s::jsonb")
+            params.append(json.dumps(si_payload, ensure_ascii=False))
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"UPDATE services SET {', '.join(sets)} WHERE {' AND '.join(where)} RETURNING {_SERVICIO_SQL}",
+            params,
+        )
+        row = cur.fetchone()
+        if row:
+            _notificar(cur, "services", [service_id])
+    return row[0] if row else None
+
+
+# Resultados de reservar_servicio()
+RESERVA_OK            = "ok"             # este móvil ganó la reserva
+RESERVA_TOMADO        = "tomado"         # otro móvil la reservó primero
+RESERVA_NO_OFRECIDO   = "no_ofrecido"    # sigue pendiente, pero no se le ofreció a este móvil
+RESERVA_NO_DISPONIBLE = "no_disponible"  # no existe o ya no está pendiente (completado, etc.)
+RESERVA_SIN_CUPO      = "sin_cupo"       # el móvil ya lleva su capacidad de servicios reservados
+
+
+def reservar_servicio(service_id: str, movil_chat_id: int, hora_reserva: str) -> tuple[str, dict | None]:
+    """
+    Reserva atómica en UNA sentencia: pasa el servicio de "pendiente" a "reservado" solo si
+    sigue pendiente, está ofrecido a este móvil y el móvil no llegó a su capacidad
+    (get_capacidad del tipo de servicio). La misma sentencia devuelve el estado previo y la
+    carga del móvil, así el handler sabe por qué perdió sin otra consulta.
+    Retorna (RESERVA_*, datos): el servicio reservado si ganó, o el estado previo si no.
+    """
+    cid = str(movil_chat_id)
+    capacidades = json.dumps({clave: get_capacidad(clave) for clave in SERVICIOS})
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            WITH carga AS (
+                SELECT COUNT(*) AS n FROM services
+                WHERE status = 'reservado' AND movil_chat_id = %s::bigint
+            ), reserva AS (
+                UPDATE services
+                SET status        = 'reservado',
+                    reservado_en  = now(),
+                    movil_chat_id = %s::bigint,
+                    movil_codigo  = COALESCE(data->'ofertas'->%s->>'codigo', movil_codigo),
+                    data          = data || jsonb_build_object('hora_reserva', %s::text)
+                WHERE service_id = %s
+                  AND status = 'pendiente'
+                  AND (data->'ofertas' ? %s OR movil_chat_id = %s::bigint)
+                  AND (SELECT n FROM carga) < COALESCE((%s::jsonb ->> servicio)::int, 1)
+                RETURNING {_SERVICIO_SQL}
+            )
+            SELECT (SELECT * FROM reserva),
+                   (SELECT {_SERVICIO_SQL} FROM services WHERE service_id = %s),
+                   (SELECT n FROM carga)
+        """, (movil_chat_id, movil_chat_id, cid, hora_reserva, service_id, cid, movil_chat_id,
+              capacidades, service_id))
+        reservado, previo, carga = cur.fetchone()
+        if reservado is not None:
+            _notificar(cur, "services", [service_id])
+
+    if reservado is not None:
+        return RESERVA_OK, reservado
+    if previo is None:
+        return RESERVA_NO_DISPONIBLE, None
+    ofrecido = cid in (previo.get("ofertas") or {}) or str(previo.get("movil_chat_id")) == cid
+    if previo.get("status") == "pendiente" and ofrecido and carga >= get_capacidad(previo.get("servicio")):
+        return RESERVA_SIN_CUPO, previo
+    if previo.get("status") == "reservado" or (previo.get("status") == "pendiente" and ofrecido):
+        # Pendiente y ofrecido pero el UPDATE no aplicó: otro móvil ganó en paralelo
+        return RESERVA_TOMADO, previo
+    if previo.get("status") == "pendiente":
+        return RESERVA_NO_OFRECIDO, previo
+    return RESERVA_NO_DISPONIBLE, previo
+
+
+def registrar_mensaje_oferta(service_id: str, ronda: int, chat_id, message_id: int) -> bool:
+    """
+    Guarda el message_id de la oferta entregada a `chat_id` (solo esa entrada de `ofertas`)
+    si la ronda `ronda` sigue abierta y le sigue ofrecida. Retorna False si ya se cerró:
+    quien la cerró no pudo retirar este mensaje, así que le toca al que lo envió.
+    """
+    cid = str(chat_id)
+    with get_db() as conn, conn.cursor() as cur:
         cur.execute("""
-            INSERT INTO services (service_id, data)
-            VALUES (%s, %s)
-            ON CONFLICT (service_id) DO UPDATE SET data = EXCLUDED.data
-        """, (service_id, json.dumps(sdata, ensure_ascii=False)))
-    cur.close()
-    conn.close()
+            UPDATE services
+            SET data = jsonb_set(data, ARRAY['ofertas', %s, 'message_id'], to_jsonb(%s::bigint))
+            WHERE service_id = %s
+              AND status = 'pendiente'
+              AND data->'ofertas' ? %s
+              AND data @> jsonb_build_object('ronda', %s::int)
+        """, (cid, message_id, service_id, cid, ronda))
+        if cur.rowcount != 1:
+            return False
+        _notificar(cur, "services", [service_id])
+        return True
+
+
+def servicios_en_espera(clave_servicio: str, limite: int) -> list[dict]:
+    """Los `limite` servicios en cola de espera más antiguos de una clave."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT {_SERVICIO_SQL} FROM services
+            WHERE status = 'en_espera' AND servicio = %s
+            ORDER BY (data->>'en_espera_ts')::float8
+            LIMIT %s
+        """, (clave_servicio, limite))
+        return [row[0] for row in cur.fetchall()]
+
+
+def expirar_cola(ahora_ts: float) -> list[dict]:
+    """Marca como "expirado" todo servicio en espera vencido y los retorna."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE services
+            SET status = 'expirado'
+            WHERE status = 'en_espera'
+              AND (data->>'expira_ts')::float8 < %s
+            RETURNING {_SERVICIO_SQL}
+        """, (ahora_ts,))
+        vencidos = [row[0] for row in cur.fetchall()]
+        if vencidos:
+            _notificar(cur, "services", [d.get("id") for d in vencidos])
+        return vencidos
+
+
+def ofertas_vencidas(ahora_ts: float) -> list[tuple[str, int]]:
+    """
+    (service_id, ronda) de los servicios pendientes cuya ronda venció (`oferta_vence`) sin
+    que nadie la cerrara, p. ej. porque el proceso que tenía el temporizador se reinició.
+    Los pendientes anteriores a esa marca los resuelve _migrar_columnas_servicios.
+    """
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT service_id, COALESCE((data->>'ronda')::int, 0) FROM services
+            WHERE status = 'pendiente'
+              AND data ? 'oferta_vence'
+              AND (data->>'oferta_vence')::float8 < %s
+        """, (ahora_ts,))
+        return cur.fetchall()
+
+
+# Archivo de servicios terminados: la tabla services solo guarda lo reciente, así el
+# despacho y los paneles de admin no se vuelven más lentos con el historial.
+ARCHIVO_DIAS        = float(os.getenv("ARCHIVO_DIAS", "7"))     # antigüedad mínima para archivar
+ARCHIVO_INTERVALO_H = float(os.getenv("ARCHIVO_INTERVALO_H", "6"))
+ARCHIVO_LOTE        = 1000
+
+_SERVICIO_TODAS = ", ".join(("service_id", "data", *SERVICIO_COLUMNAS, *SERVICIO_MARCAS))
+_SERVICIO_EXCLUDED = ", ".join(f"{c} = EXCLUDED.{c}" for c in ("data", *SERVICIO_COLUMNAS, *SERVICIO_MARCAS))
+
+
+def archivar_servicios(dias: float = ARCHIVO_DIAS) -> int:
+    """
+    Mueve a services_archivo los servicios terminados (completados / expirados) hace más
+    de `dias` días, por lotes de ARCHIVO_LOTE en una sentencia cada uno. Retorna cuántos movió.
+    """
+    total = 0
+    with get_db() as conn, conn.cursor() as cur:
+        while True:
+            cur.execute(f"""
+                WITH movidos AS (
+                    DELETE FROM services
+                    WHERE service_id IN (
+                        SELECT service_id FROM services
+                        WHERE status = ANY(%s)
+                          AND COALESCE(completado_en, creado_en) < now() - make_interval(secs => %s)
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING {_SERVICIO_TODAS}
+                )
+                INSERT INTO services_archivo ({_SERVICIO_TODAS})
+                SELECT {_SERVICIO_TODAS} FROM movidos
+                ON CONFLICT (service_id) DO UPDATE SET {_SERVICIO_EXCLUDED}
+                RETURNING service_id
+            """, (list(ESTADOS_TERMINALES), dias * 86400, ARCHIVO_LOTE))
+            movidos = [row[0] for row in cur.fetchall()]
+            if movidos:
+                _notificar(cur, "services", movidos)
+            total += len(movidos)
+            if len(movidos) < ARCHIVO_LOTE:
+                return total
+
+
+# --- Acceso asíncrono a datos ---
+#
+# psycopg2 es bloqueante: los handlers nunca deben llamarlo directo desde la corrutina,
+# porque una consulta lenta congela todos los chats. Cada helper tiene su versión
+# awaitable (sufijo _async) que corre en un executor dedicado y acotado, así el
+# event loop sigue atendiendo otras actualizaciones mientras la BD responde.
+
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="pronto-db")
+
+
+async def run_db(func, *args, **kwargs):
+    """Ejecuta un helper bloqueante de BD en el executor dedicado y espera su resultado."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+def _awaitable(func):
+    """Crea la versión awaitable de un helper bloqueante de BD."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    wrapper.__name__     = f"{func.__name__}_async"
+    wrapper.__qualname__ = f"{func.__qualname__}_async"
+    return wrapper
+
+
+# --- Concurrencia ---
+#
+# Las actualizaciones de Telegram se procesan en paralelo (hasta MAX_CONCURRENT_UPDATES),
+# pero las de un mismo chat se atienden en orden: el flujo por pasos de cada usuario
+# depende de context.user_data. Las transiciones de un servicio (asignar, reservar,
+# completar, cancelar) se serializan con un candado por servicio.
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+
+# Con varios procesos, los candados de servicio se extienden a todos con advisory locks
+# de PostgreSQL (pg_try_advisory_lock, reintentando sin bloquear el executor). Los candados
+# viven en UNA conexión propia del proceso, fuera del pool: la sección crítica necesita
+# conexiones del pool para sus consultas y no debe competir con los candados por ellas.
+# El candado local va primero: en cada proceso solo una corrutina pide cada llave a la BD.
+BLOQUEO_DISTRIBUIDO = os.getenv("BLOQUEO_DISTRIBUIDO", "1" if WORKERS_TOTAL > 1 else "0") == "1"
+BLOQUEO_TIMEOUT_S   = float(os.getenv("BLOQUEO_TIMEOUT_S", "10"))
+BLOQUEO_REINTENTO_S = float(os.getenv("BLOQUEO_REINTENTO_S", "5"))   # reintento de jobs sin candado
+
+
+class ConexionCandados:
+    """Conexión dedicada (autocommit) donde este proceso toma y suelta sus advisory locks."""
+
+    def __init__(self, dsn: str):
+        self._dsn   = dsn
+        self._conn  = None
+        self._mutex = threading.Lock()
+
+    def advisory(self, accion: str, llave: str) -> bool:
+        funcion = "pg_try_advisory_lock" if accion == "tomar" else "pg_advisory_unlock"
+        with self._mutex:
+            if self._conn is None:
+                self._conn = psycopg2.connect(self._dsn)
+                self._conn.autocommit = True
+            try:
+                with self._conn.cursor() as cur:
+                    cur.execute(f"SELECT {funcion}(hashtext(%s))", (llave,))
+                    return cur.fetchone()[0]
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # La sesión murió (y con ella sus candados): se abre otra en el próximo uso
+                self._cerrar()
+                raise
+
+    def cerrar(self):
+        with self._mutex:
+            self._cerrar()
+
+    def _cerrar(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+CONEXION_CANDADOS = ConexionCandados(DATABASE_URL)
+
+
+class CandadoOcupado(TimeoutError):
+    """Otro proceso retuvo el candado de `llave` más de BLOQUEO_TIMEOUT_S."""
+
+
+@asynccontextmanager
+async def candado_pg(llave: str):
+    """Advisory lock de sesión de PostgreSQL sobre `llave`, compartido por todos los procesos."""
+    limite = monotonic() + BLOQUEO_TIMEOUT_S
+    while not await run_db(CONEXION_CANDADOS.advisory, "tomar", llave):
+        if monotonic() > limite:
+            raise CandadoOcupado(f"No se obtuvo el candado {llave} en {BLOQUEO_TIMEOUT_S:g}s")
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            await run_db(CONEXION_CANDADOS.advisory, "soltar", llave)
+        except psycopg2.Error as e:
+            print(f"[CANDADOS] No se pudo soltar {llave}: {e}")
+
+
+class CandadosPorClave:
+    """
+    Candados asyncio por clave (chat, servicio). Se liberan cuando nadie los usa.
+    Con `distribuido` (prefijo) y BLOQUEO_DISTRIBUIDO, además toman el advisory lock
+    "<prefijo>:<clave>" para excluir a los otros procesos.
+    """
+
+    def __init__(self, distribuido: str | None = None):
+        self._candados: dict = {}   # clave -> [asyncio.Lock, usuarios]
+        self._distribuido = distribuido
+
+    @asynccontextmanager
+    async def bloquear(self, clave):
+        entrada = self._candados.get(clave)
+        if entrada is None:
+            entrada = self._candados[clave] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                if self._distribuido and BLOQUEO_DISTRIBUIDO:
+                    async with candado_pg(f"{self._distribuido}:{clave}"):
+                        yield
+                else:
+                    yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._candados[clave]
+
+
+_CANDADOS_CHAT     = CandadosPorClave()
+_CANDADOS_SERVICIO = CandadosPorClave(distribuido="servicio")
+_CANDADOS_CANAL    = CandadosPorClave(distribuido="canal")   # publicaciones en canal de un servicio, en orden
+
+
+def _clave_chat(update: object):
+    """Chat que ordena una actualización (o el usuario si no hay chat)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ProcesadorPorChat(BaseUpdateProcessor):
+    """
+    Procesa actualizaciones en paralelo, manteniendo el orden dentro de cada chat.
+    El cupo de MAX_CONCURRENT_UPDATES se toma después del candado del chat: los updates
+    en fila de un chat ocupado no le quitan cupo a los demás chats.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # El semáforo de PTB se toma antes de do_process_update; se deja prácticamente sin límite
+        super().__init__(2 ** 30)
+        self._cupos = asyncio.Semaphore(max_concurrent_updates)
+
+    async def do_process_update(self, update, coroutine):
+        clave = _clave_chat(update)
+        if clave is None:
+            async with self._cupos:
+                await coroutine
+            return
+        async with _CANDADOS_CHAT.bloquear(clave), self._cupos:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 
 async def backup_file(context, filename: str):
@@ -382,68 +1473,1029 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
-def seleccionar_movil_mas_cercano(clave_servicio: str, lat_cliente, lon_cliente) -> dict | None:
+# --- Motor vectorizado de distancias (NumPy) ---
+#
+# Misma fórmula haversine que haversine_distance, sobre arreglos: una llamada calcula
+# las distancias de un punto a N móviles (uno-a-muchos) o la matriz completa entre
+# dos conjuntos de puntos (muchos-a-muchos, para despacho por lotes y reportes).
+# Coincide con la versión escalar dentro de ~1e-9 km.
+
+RADIO_TIERRA_KM = 6371.0
+
+
+def preparar_posiciones(lats, lons) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Precalcula (lat en radianes, lon en radianes, cos(lat)) para un conjunto de posiciones."""
+    lat_rad = np.radians(np.asarray(lats, dtype=float))
+    lon_rad = np.radians(np.asarray(lons, dtype=float))
+    return lat_rad, lon_rad, np.cos(lat_rad)
+
+
+def _haversine_rad(lat1, lon1, cos1, lat2, lon2, cos2) -> np.ndarray:
+    a = np.sin((lat2 - lat1) / 2) ** 2 + cos1 * cos2 * np.sin((lon2 - lon1) / 2) ** 2
+    a = np.clip(a, 0.0, 1.0)
+    return RADIO_TIERRA_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def distancias_desde(lat: float, lon: float, posiciones: tuple) -> np.ndarray:
+    """Distancias (km) de un punto a todas las posiciones ya preparadas (uno-a-muchos)."""
+    lat_rad, lon_rad, cos_lat = posiciones
+    lat0, lon0 = math.radians(lat), math.radians(lon)
+    return _haversine_rad(lat0, lon0, math.cos(lat0), lat_rad, lon_rad, cos_lat)
+
+
+def matriz_distancias(origenes: tuple, destinos: tuple) -> np.ndarray:
+    """Matriz (len(origenes) x len(destinos)) de distancias en km entre posiciones preparadas."""
+    lat1, lon1, cos1 = (x[:, None] for x in origenes)
+    lat2, lon2, cos2 = (x[None, :] for x in destinos)
+    return _haversine_rad(lat1, lon1, cos1, lat2, lon2, cos2)
+
+
+# --- Índice espacial de la flota ---
+
+INDICE_CELDA_GRADOS = float(os.getenv("INDICE_CELDA_GRADOS", "0.02"))  # ~2.2 km por celda
+KM_POR_GRADO        = 6371.0 * math.pi / 180
+
+
+class IndiceFlota:
     """
-    Busca el móvil activo disponible más cercano al cliente para la clave de servicio dada.
-    Trabaja siempre con claves internas. Los registros antiguos son normalizados al vuelo.
+    Índice espacial en memoria de los móviles ACTIVOS, separado por clave de servicio.
+    - Cuadrícula de celdas de INDICE_CELDA_GRADOS: la búsqueda recorre anillos de celdas
+      alrededor del cliente y se detiene cuando ningún móvil fuera del anillo puede estar
+      más cerca que el mejor encontrado.
+    - Se mantiene al día desde los helpers de escritura (save_mobile / update_mobile /
+      delete_mobile), así el despacho no lee la tabla mobiles.
+    Es thread-safe: los helpers de BD corren en el executor.
     """
-    mobiles    = get_mobiles()
-    candidatos = []
 
-    for chat_id_str, m in mobiles.items():
-        if not m.get("activo"):
-            continue
+    def __init__(self, celda_grados: float):
+        self._celda  = celda_grados
+        self._lock   = threading.Lock()
+        self._moviles: dict[str, dict]       = {}  # user_id -> datos del móvil (+ "_celda")
+        self._celdas: dict[str, dict]        = {}  # clave -> {(ix, iy): {user_id}}
+        self._sin_ubicacion: dict[str, set]  = {}  # clave -> {user_id} activos sin GPS
 
-        # Normalizar el servicio guardado en el registro (compatibilidad con datos viejos)
-        clave_movil = normalizar_servicio(m.get("servicio", ""))
-        if clave_movil != clave_servicio:
-            continue
+    def _celda_de(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self._celda), math.floor(lon / self._celda)
 
-        puede, _ = mobile_can_work(m)
-        if not puede:
-            continue
+    def _quitar(self, user_id: str):
+        m = self._moviles.pop(user_id, None)
+        if not m:
+            return
+        clave, celda = m["servicio"], m["_celda"]
+        if celda is None:
+            self._sin_ubicacion.get(clave, set()).discard(user_id)
+            return
+        celdas = self._celdas.get(clave, {})
+        ocupantes = celdas.get(celda)
+        if ocupantes is not None:
+            ocupantes.discard(user_id)
+            if not ocupantes:
+                del celdas[celda]
+
+    def _agregar(self, user_id: str, m: dict):
+        clave = normalizar_servicio(m.get("servicio") or "")
+        if not m.get("activo") or not clave:
+            return
+        lat, lon = m.get("lat"), m.get("lon")
+        celda = self._celda_de(lat, lon) if lat is not None and lon is not None else None
+        self._moviles[user_id] = {**m, "servicio": clave, "_celda": celda}
+        if celda is not None:
+            lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+            self._moviles[user_id]["_rad"] = (lat_rad, lon_rad, math.cos(lat_rad))
+        if celda is None:
+            self._sin_ubicacion.setdefault(clave, set()).add(user_id)
+        else:
+            self._celdas.setdefault(clave, {}).setdefault(celda, set()).add(user_id)
+
+    def cargar(self, mobiles: dict):
+        """Reconstruye el índice desde el dict completo {user_id: datos}."""
+        with self._lock:
+            self._moviles.clear()
+            self._celdas.clear()
+            self._sin_ubicacion.clear()
+            for uid, m in mobiles.items():
+                self._agregar(uid, m)
+
+    def actualizar(self, user_id: str, m: dict):
+        """Refleja el registro completo de un móvil (lo saca si quedó inactivo)."""
+        with self._lock:
+            self._quitar(user_id)
+            self._agregar(user_id, m)
+
+    def quitar(self, user_id: str):
+        with self._lock:
+            self._quitar(user_id)
+
+    def obtener(self, user_id: str) -> dict | None:
+        """Datos del móvil si está activo en el índice (copia), o None."""
+        with self._lock:
+            m = self._moviles.get(str(user_id))
+            return dict(m) if m else None
+
+    def _posiciones(self, uids) -> tuple:
+        """Arreglos precalculados (lat_rad, lon_rad, cos_lat) de los móviles dados."""
+        rad = np.array([self._moviles[u]["_rad"] for u in uids], dtype=float).reshape(-1, 3)
+        return rad[:, 0], rad[:, 1], rad[:, 2]
+
+    def ubicados(self, clave: str, aceptar=None) -> tuple[list, tuple]:
+        """
+        Foto de los móviles ubicados de una clave: (user_ids, posiciones preparadas).
+        Para cálculos por lotes con matriz_distancias.
+        """
+        with self._lock:
+            uids = [
+                u for ocupantes in self._celdas.get(clave, {}).values() for u in ocupantes
+                if aceptar is None or aceptar(self._moviles[u])
+            ]
+            return uids, self._posiciones(uids)
+
+    def _candidato(self, user_id: str, dist: float) -> dict:
+        m = self._moviles[user_id]
+        return {
+            "chat_id":   int(user_id),
+            "codigo":    m.get("codigo"),
+            "servicio":  m["servicio"],
+            "distancia": dist,
+        }
+
+    def cercanos(self, clave: str, lat, lon, k: int = 1, radio_km: float | None = None,
+                 aceptar=None, excluir=()) -> list[dict]:
+        """
+        Los `k` móviles activos más cercanos de la clave dada, ordenados por distancia
+        (empates al azar), opcionalmente solo dentro de `radio_km`.
+        - `aceptar(datos)` filtra candidatos (ej: mobile_can_work); `excluir` son user_ids a omitir.
+        - Los anillos de celdas se recorren hasta tener k candidatos y que ningún móvil fuera
+          del anillo pueda mejorar el k-ésimo; la selección final es parcial (argpartition).
+        - Los móviles sin GPS completan la lista al final con distancia infinita, en orden
+          aleatorio (solo sin radio). Si el cliente no tiene GPS el radio no aplica y todos
+          quedan a distancia infinita.
+        """
+        if k < 1:
+            return []
+        excluir = {str(u) for u in excluir}
+
+        def valido(uid) -> bool:
+            return uid not in excluir and (aceptar is None or aceptar(self._moviles[uid]))
+
+        with self._lock:
+            celdas = self._celdas.get(clave, {})
+            vistos_uids: list[str] = []
+            vistos_dist: list[np.ndarray] = []
+            hay_gps = lat is not None and lon is not None
+
+            if hay_gps and celdas:
+                ix0, iy0 = self._celda_de(lat, lon)
+                total = 0
+
+                def revisar(uids):
+                    nonlocal total
+                    uids = [u for u in uids if valido(u)]
+                    if uids:
+                        vistos_uids.extend(uids)
+                        vistos_dist.append(distancias_desde(lat, lon, self._posiciones(uids)))
+                        total += len(uids)
+
+                def kesima() -> float:
+                    if total < k:
+                        return float("inf")
+                    return float(np.partition(np.concatenate(vistos_dist), k - 1)[k - 1])
+
+                revisar(celdas.get((ix0, iy0), ()))
+                r = 0
+                while True:
+                    # Todo lo que está fuera de los anillos 0..r queda al menos a r celdas.
+                    lat_ext = min(89.0, abs(lat) + (r + 1) * self._celda)
+                    cota    = r * self._celda * KM_POR_GRADO * math.cos(math.radians(lat_ext))
+                    if kesima() <= cota or (radio_km is not None and cota > radio_km):
+                        break
+                    r += 1
+                    anillo = []
+                    if 8 * r >= len(celdas):
+                        # Anillo más grande que las celdas ocupadas: recorrerlas directo es más barato.
+                        for (ix, iy), ocupantes in celdas.items():
+                            if max(abs(ix - ix0), abs(iy - iy0)) >= r:
+                                anillo.extend(ocupantes)
+                        revisar(anillo)
+                        break
+                    for dx in range(-r, r + 1):
+                        for dy in ((-r, r) if abs(dx) < r else range(-r, r + 1)):
+                            ocupantes = celdas.get((ix0 + dx, iy0 + dy))
+                            if ocupantes:
+                                anillo.extend(ocupantes)
+                    revisar(anillo)
+
+            elegidos = []
+            if vistos_uids:
+                dist = np.concatenate(vistos_dist)
+                if radio_km is not None:
+                    dentro      = dist <= radio_km
+                    vistos_uids = [u for u, ok in zip(vistos_uids, dentro) if ok]
+                    dist        = dist[dentro]
+                n = min(k, len(dist))
+                if n:
+                    idx = np.argpartition(dist, n - 1)[:n] if n < len(dist) else np.arange(len(dist))
+                    # Orden por distancia con desempate aleatorio
+                    idx = idx[np.lexsort((np.random.random(len(idx)), dist[idx]))]
+                    elegidos = [self._candidato(vistos_uids[i], float(dist[i])) for i in idx]
+
+            if len(elegidos) < k and (radio_km is None or not hay_gps):
+                # Sin GPS del cliente o del móvil: distancia infinita, en orden aleatorio
+                ya   = {c["chat_id"] for c in elegidos}
+                resto = [
+                    uid for uid in self._sin_ubicacion.get(clave, set())
+                    | ({u for ocupantes in celdas.values() for u in ocupantes} if not hay_gps else set())
+                    if int(uid) not in ya and valido(uid)
+                ]
+                random.shuffle(resto)
+                elegidos.extend(self._candidato(u, float("inf")) for u in resto[:k - len(elegidos)])
+            return elegidos
+
+
+INDICE_FLOTA = IndiceFlota(INDICE_CELDA_GRADOS)
+
+
+# Cuántos móviles muestra el panel "📍 Móviles cercanos a un servicio"
+ADMIN_CERCANOS_K = int(os.getenv("ADMIN_CERCANOS_K", "5"))
+
+# Radio máximo (km) para ofrecer un servicio a un móvil ubicado; vacío = sin límite
+DESPACHO_RADIO_KM = float(os.getenv("DESPACHO_RADIO_KM")) if os.getenv("DESPACHO_RADIO_KM") else None
+
+
+def seleccionar_moviles_cercanos(clave_servicio: str, lat_cliente, lon_cliente, k: int = 1,
+                                 radio_km: float | None = None, excluir=()) -> list[dict]:
+    """
+    Los `k` móviles activos disponibles más cercanos al cliente (ordenados por distancia),
+    opcionalmente dentro de `radio_km` y omitiendo los chat_id de `excluir`.
+    Consulta el índice en memoria (INDICE_FLOTA), no la tabla mobiles.
+    """
+    return INDICE_FLOTA.cercanos(
+        clave_servicio, lat_cliente, lon_cliente, k=k, radio_km=radio_km,
+        aceptar=lambda m: mobile_can_work(m)[0], excluir=excluir,
+    )
 
-        m_lat = m.get("lat")
-        m_lon = m.get("lon")
 
-        if all(x is not None for x in [m_lat, m_lon, lat_cliente, lon_cliente]):
-            dist = haversine_distance(lat_cliente, lon_cliente, m_lat, m_lon)
+def carga_moviles(chat_ids, incluir_ofertas: bool = False) -> dict[str, int]:
+    """
+    Servicios reservados (en curso) por móvil, solo para los chat_id dados (índice parcial).
+    Con incluir_ofertas suma también los servicios pendientes que tiene ofrecidos sin responder.
+    """
+    ids = [int(c) for c in chat_ids]
+    if not ids:
+        return {}
+    with get_db() as conn, conn.cursor() as cur:
+        if not incluir_ofertas:
+            cur.execute("""
+                SELECT movil_chat_id::text, COUNT(*)
+                FROM services
+                WHERE status = 'reservado'
+                  AND movil_chat_id = ANY(%s::bigint[])
+                GROUP BY 1
+            """, (ids,))
         else:
-            dist = float("inf")
+            cur.execute("""
+                SELECT cid, COUNT(*)
+                FROM (
+                    SELECT movil_chat_id::text AS cid
+                    FROM services
+                    WHERE status = 'reservado'
+                      AND movil_chat_id = ANY(%s::bigint[])
+                    UNION ALL
+                    SELECT o.cid
+                    FROM services, jsonb_object_keys(data->'ofertas') AS o(cid)
+                    WHERE status = 'pendiente'
+                      AND data->'ofertas' ?| %s::text[]
+                      AND o.cid = ANY(%s::text[])
+                ) t
+                GROUP BY 1
+            """, (ids, [str(i) for i in ids], [str(i) for i in ids]))
+        return {cid: n for cid, n in cur.fetchall()}
+
+
+def seleccionar_moviles_disponibles(clave_servicio: str, lat_cliente, lon_cliente, k: int = 1,
+                                    radio_km: float | None = None, excluir=()) -> list[dict]:
+    """
+    Como seleccionar_moviles_cercanos, pero descarta móviles que ya llevan su capacidad
+    de servicios en curso (SERVICIOS[...]["capacidad"]) y prefiere los libres:
+    ordena por (servicios en curso, distancia). Cada candidato trae su "carga".
+    """
+    capacidad = get_capacidad(clave_servicio)
+    pedidos   = max(k, 1) * 4
+    while True:
+        cercanos = seleccionar_moviles_cercanos(
+            clave_servicio, lat_cliente, lon_cliente, k=pedidos, radio_km=radio_km, excluir=excluir
+        )
+        cargas = carga_moviles(c["chat_id"] for c in cercanos)
+        libres = []
+        for c in cercanos:
+            c["carga"] = cargas.get(str(c["chat_id"]), 0)
+            if c["carga"] < capacidad:
+                libres.append(c)
+        # Si hay suficientes libres, o ya no hay más móviles que mirar, terminamos
+        if len(libres) >= k or len(cercanos) < pedidos:
+            libres.sort(key=lambda c: (c["carga"], c["distancia"]))
+            return libres[:k]
+        pedidos *= 2
+
+
+# --- Asignación por lotes (ráfagas de solicitudes) ---
+#
+# Con DESPACHO_LOTE_MS > 0 las solicitudes nuevas de una misma clave que llegan dentro de
+# esa ventana se asignan juntas: cada solicitud recibe un móvil distinto minimizando la
+# distancia total de recogida (algoritmo húngaro sobre la matriz de distancias), en vez de
+# darle al primero el móvil que era mejor para el tercero. Lotes más grandes que
+# DESPACHO_LOTE_HUNGARO_MAX usan la asignación voraz por orden de llegada.
 
-        candidatos.append({
-            "chat_id":  int(chat_id_str),
-            "codigo":   m.get("codigo"),
-            "servicio": clave_servicio,  # siempre clave interna
-            "distancia": dist,
-        })
+DESPACHO_LOTE_MS          = float(os.getenv("DESPACHO_LOTE_MS", "0"))   # 0 = desactivado
+DESPACHO_LOTE_HUNGARO_MAX = int(os.getenv("DESPACHO_LOTE_HUNGARO_MAX", "150"))
 
-    if not candidatos:
-        return None
+_COSTO_OCUPADO   = 1e5   # km "extra" por servicio en curso: los libres van primero (como en el despacho normal)
+_COSTO_IMPOSIBLE = 1e9   # pareja no permitida (fuera de radio o descartado)
 
-    candidatos.sort(key=lambda x: x["distancia"])
-    dist_min  = candidatos[0]["distancia"]
-    empatados = [c for c in candidatos if c["distancia"] == dist_min]
-    return random.choice(empatados)
+METRICAS_LOTE = {
+    "lotes": 0, "solicitudes": 0, "asignadas": 0, "voraz_forzado": 0,
+    "km_optimo": 0.0, "km_voraz": 0.0, "asignadas_voraz": 0,
+}
+
+
+def asignacion_hungara(costos: np.ndarray) -> np.ndarray:
+    """
+    Asignación de costo total mínimo (algoritmo húngaro con potenciales, O(n²·m)).
+    Retorna, por fila, la columna asignada (-1 si hay más filas que columnas y quedó sin una).
+    """
+    costos = np.asarray(costos, dtype=float)
+    n, m = costos.shape
+    if n == 0 or m == 0:
+        return np.full(n, -1, dtype=int)
+    if n > m:
+        cols = asignacion_hungara(costos.T)
+        filas = np.full(n, -1, dtype=int)
+        filas[cols] = np.arange(m)
+        return filas
+
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p    = np.zeros(m + 1, dtype=int)   # p[j] = fila (1..n) asignada a la columna j; 0 = libre
+    way  = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0   = p[j0]
+            libre = ~used[1:]
+            cur   = costos[i0 - 1] - u[i0] - v[1:]
+            mejora = libre & (cur < minv[1:])
+            minv[1:][mejora] = cur[mejora]
+            way[1:][mejora]  = j0
+            cand  = np.where(libre, minv[1:], np.inf)
+            j1    = int(np.argmin(cand)) + 1
+            delta = cand[j1 - 1]
+            u[p[used]] += delta
+            v[used]    -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    filas = np.full(n, -1, dtype=int)
+    asignadas = np.nonzero(p[1:])[0]
+    filas[p[1:][asignadas] - 1] = asignadas
+    return filas
+
+
+def asignacion_voraz(costos: np.ndarray) -> np.ndarray:
+    """Cada fila, en orden, toma la columna libre más barata (lo que hace el despacho uno a uno)."""
+    costos = np.array(costos, dtype=float)
+    filas = np.full(costos.shape[0], -1, dtype=int)
+    for i in range(costos.shape[0]):
+        j = int(np.argmin(costos[i])) if costos.shape[1] else -1
+        if j >= 0 and costos[i, j] < _COSTO_IMPOSIBLE:
+            filas[i] = j
+            costos[:, j] = np.inf
+    return filas
+
+
+def asignar_lote(clave_servicio: str, solicitudes: list[dict]) -> tuple[list, dict]:
+    """
+    Asigna a cada solicitud (con GPS) de un lote un móvil disponible distinto, minimizando
+    la distancia total (libres antes que ocupados). Retorna (candidato o None por
+    solicitud, métricas del lote comparadas con la asignación voraz).
+    """
+    n = len(solicitudes)
+    capacidad = get_capacidad(clave_servicio)
+    uids, posiciones = INDICE_FLOTA.ubicados(clave_servicio, aceptar=lambda m: mobile_can_work(m)[0])
+    cargas = carga_moviles(uids)
+    libres = [i for i, u in enumerate(uids) if cargas.get(str(u), 0) < capacidad]
+    metricas = {"solicitudes": n, "asignadas": 0, "voraz_forzado": 0,
+                "km_optimo": 0.0, "km_voraz": 0.0, "asignadas_voraz": 0}
+    if not libres or not n:
+        return [None] * n, metricas
+
+    uids       = [uids[i] for i in libres]
+    posiciones = tuple(x[libres] for x in posiciones)
+    origenes   = preparar_posiciones([s["lat"] for s in solicitudes], [s["lon"] for s in solicitudes])
+    dist       = matriz_distancias(origenes, posiciones)
+
+    costos = dist + _COSTO_OCUPADO * np.array([cargas.get(str(u), 0) for u in uids], dtype=float)
+    if DESPACHO_RADIO_KM is not None:
+        costos[dist > DESPACHO_RADIO_KM] = _COSTO_IMPOSIBLE
+    for i, s in enumerate(solicitudes):
+        descartados = {str(c) for c in s.get("descartados") or ()}
+        if descartados:
+            costos[i, [str(u) in descartados for u in uids]] = _COSTO_IMPOSIBLE
+
+    # Cada fila usa alguna de sus n columnas más baratas en una asignación óptima:
+    # basta con la unión de esas columnas (recorta flotas grandes).
+    if len(uids) > n:
+        cols = np.unique(np.argpartition(costos, n - 1, axis=1)[:, :n])
+        uids, dist, costos = [uids[j] for j in cols], dist[:, cols], costos[:, cols]
+
+    voraz = asignacion_voraz(costos)
+    if max(costos.shape) <= DESPACHO_LOTE_HUNGARO_MAX:
+        optima = asignacion_hungara(costos)
+    else:
+        optima = voraz
+        metricas["voraz_forzado"] = 1
+
+    resultado = []
+    for i, j in enumerate(optima):
+        if j < 0 or costos[i, j] >= _COSTO_IMPOSIBLE:
+            resultado.append(None)
+            continue
+        m = INDICE_FLOTA.obtener(uids[j]) or {}
+        resultado.append({
+            "chat_id":   int(uids[j]),
+            "codigo":    m.get("codigo"),
+            "servicio":  clave_servicio,
+            "distancia": float(dist[i, j]),
+            "carga":     cargas.get(str(uids[j]), 0),
+        })
+        metricas["asignadas"] += 1
+        metricas["km_optimo"] += float(dist[i, j])
+    for i, j in enumerate(voraz):
+        if j >= 0:
+            metricas["asignadas_voraz"] += 1
+            metricas["km_voraz"] += float(dist[i, j])
+    return resultado, metricas
 
 
 def asignar_codigo_movil(clave_servicio: str) -> str:
     """
     Genera el siguiente código correlativo para un móvil (ej: D003, SE007).
-    Trabaja con la clave interna del servicio.
+    Trabaja con la clave interna del servicio. El número sale de un contador
+    atómico por prefijo: dos registros simultáneos nunca reciben el mismo código.
     """
-    mobiles = get_mobiles()
     prefijo = get_prefijo(clave_servicio)
-    numeros = []
-    for m in mobiles.values():
-        codigo = m.get("codigo", "")
-        if codigo.startswith(prefijo):
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO codigo_contadores (prefijo, ultimo) VALUES (%s, 1)
+            ON CONFLICT (prefijo) DO UPDATE SET ultimo = codigo_contadores.ultimo + 1
+            RETURNING ultimo
+        """, (prefijo,))
+        next_num = cur.fetchone()[0]
+    return f"{prefijo}{next_num:03d}"
+
+
+# --- Versiones awaitable de los helpers de BD (usar siempre desde los handlers) ---
+
+get_mobiles_async                     = _awaitable(get_mobiles)
+get_mobile_async                      = _awaitable(get_mobile)
+get_mobile_por_codigo_async           = _awaitable(get_mobile_por_codigo)
+save_mobile_async                     = _awaitable(save_mobile)
+update_mobile_async                   = _awaitable(update_mobile)
+delete_mobile_async                   = _awaitable(delete_mobile)
+servicios_activos_async               = _awaitable(servicios_activos)
+get_service_async                     = _awaitable(get_service)
+create_service_async                  = _awaitable(create_service)
+update_service_async                  = _awaitable(update_service)
+reservar_servicio_async               = _awaitable(reservar_servicio)
+registrar_mensaje_oferta_async        = _awaitable(registrar_mensaje_oferta)
+seleccionar_moviles_cercanos_async    = _awaitable(seleccionar_moviles_cercanos)
+seleccionar_moviles_disponibles_async = _awaitable(seleccionar_moviles_disponibles)
+carga_moviles_async                   = _awaitable(carga_moviles)
+asignar_lote_async                    = _awaitable(asignar_lote)
+servicios_en_espera_async             = _awaitable(servicios_en_espera)
+expirar_cola_async                    = _awaitable(expirar_cola)
+ofertas_vencidas_async                = _awaitable(ofertas_vencidas)
+archivar_servicios_async              = _awaitable(archivar_servicios)
+asignar_codigo_movil_async            = _awaitable(asignar_codigo_movil)
+
+
+# --- Cola de salida hacia Telegram ---
+#
+# Todo mensaje "secundario" (ofertas, avisos al cliente, canal, admins) pasa por una cola
+# con prioridad y límites de tasa tipo token bucket: global (~30/s del bot) y por chat
+# (1/s en privados, 20/min en grupos/canales). Un mensaje cuyo chat no tiene turno no
+# ocupa un worker esperando: se aparta y vuelve a la cola cuando le toca, así las ofertas
+# no quedan detrás de una ráfaga al canal. Un RetryAfter de Telegram pausa solo el chat que
+# lo recibió (el límite suele ser por chat, ej: 20/min en canales); si llegan de varios
+# chats a la vez es una inundación del bot y se pausan todos los envíos. Un error de red se
+# reintenta con espera creciente, en vez de perderse en un except. Los handlers encolan y siguen: responden apenas guardan el estado.
+
+PRIORIDAD_OFERTA  = 0   # ofertas a móviles y su retiro: lo más urgente
+PRIORIDAD_CLIENTE = 1   # avisos al cliente / móvil
+PRIORIDAD_CANAL   = 2   # resúmenes en los canales de servicio
+PRIORIDAD_ADMIN   = 3   # notificaciones a administradores
+
+SALIDA_WORKERS     = int(os.getenv("SALIDA_WORKERS", "8"))
+SALIDA_TASA_GLOBAL = float(os.getenv("SALIDA_TASA_GLOBAL", "25"))   # mensajes/s de todo el bot
+SALIDA_TASA_CHAT   = float(os.getenv("SALIDA_TASA_CHAT", "1"))      # mensajes/s por chat privado
+SALIDA_TASA_GRUPO  = float(os.getenv("SALIDA_TASA_GRUPO", "0.33"))  # mensajes/s por grupo o canal
+SALIDA_REINTENTOS  = int(os.getenv("SALIDA_REINTENTOS", "3"))
+SALIDA_BACKOFF_S   = float(os.getenv("SALIDA_BACKOFF_S", "1"))      # espera base entre reintentos por red
+SALIDA_FLOOD_CHATS = int(os.getenv("SALIDA_FLOOD_CHATS", "3"))      # chats distintos con RetryAfter ...
+SALIDA_FLOOD_S     = float(os.getenv("SALIDA_FLOOD_S", "2"))        # ... en esta ventana = pausa global
+
+
+class CuboTokens:
+    """Token bucket que reserva turno: reservar() retorna cuántos segundos esperar antes de enviar."""
+
+    def __init__(self, tasa: float, rafaga: float):
+        self.tasa    = tasa
+        self.rafaga  = rafaga
+        self.tokens  = rafaga
+        self.ultimo  = monotonic()
+        self.pausa_hasta = 0.0   # RetryAfter de Telegram para este cubo
+
+    def reservar(self) -> float:
+        ahora = monotonic()
+        self.tokens = min(self.rafaga, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+        self.tokens -= 1
+        turno = 0.0 if self.tokens >= 0 else -self.tokens / self.tasa
+        return max(turno, self.pausa_hasta - ahora)
+
+    def pausar(self, segundos: float):
+        self.pausa_hasta = max(self.pausa_hasta, monotonic() + segundos)
+
+    def lleno(self) -> bool:
+        ahora = monotonic()
+        return self.pausa_hasta <= ahora and self.tokens + (ahora - self.ultimo) * self.tasa >= self.rafaga
+
+
+class ColaSalida:
+    """Cola con prioridad de llamadas salientes al bot (send_message, edit_message_text, ...)."""
+
+    def __init__(self, workers: int):
+        self._n_workers  = workers
+        self._cola: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._bot        = None
+        self._seq        = 0
+        self._global     = CuboTokens(SALIDA_TASA_GLOBAL, SALIDA_TASA_GLOBAL)
+        self._por_chat: dict[int, CuboTokens] = {}
+        self._pausa_hasta = 0.0
+        self._retry_after_chats: dict = {}   # chat_id -> último RetryAfter (detección de inundación)
+        self._diferidos: set[asyncio.TimerHandle] = set()   # mensajes apartados hasta su turno
+        self.metricas    = {"enviados": 0, "fallidos": 0, "reintentos": 0, "retry_after": 0, "diferidos": 0}
+
+    def iniciar(self, bot):
+        self._bot  = bot
+        self._cola = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._n_workers)]
+        print(f"[SALIDA] Cola de salida iniciada ({self._n_workers} workers).")
+
+    async def detener(self):
+        for h in self._diferidos:
+            h.cancel()
+        self._diferidos.clear()
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def pendientes(self) -> int:
+        return (self._cola.qsize() if self._cola else 0) + len(self._diferidos)
+
+    def encolar(self, chat_id, texto: str | None = None, prioridad: int = PRIORIDAD_ADMIN,
+                metodo: str = "send_message", **kwargs):
+        """Encola sin esperar (los errores solo se registran en el log)."""
+        self._poner(prioridad, metodo, chat_id, texto, kwargs, None, 0)
+
+    async def enviar(self, chat_id, texto: str | None = None, prioridad: int = PRIORIDAD_OFERTA,
+                     metodo: str = "send_message", **kwargs):
+        """Encola y espera el resultado (ej: el Message para guardar su message_id)."""
+        if self._cola is None:
+            raise RuntimeError("Cola de salida no iniciada")
+        futuro = asyncio.get_running_loop().create_future()
+        self._poner(prioridad, metodo, chat_id, texto, kwargs, futuro, 0)
+        return await futuro
+
+    @staticmethod
+    def _args(texto, kwargs) -> dict:
+        return {**kwargs, "text": texto} if texto is not None else kwargs
+
+    def _poner(self, prioridad, metodo, chat_id, texto, kwargs, futuro, intento):
+        if self._cola is None:
+            print(f"[SALIDA] Cola no iniciada; se descarta {metodo} a {chat_id}.")
+            return
+        self._seq += 1
+        self._cola.put_nowait((prioridad, self._seq, (metodo, chat_id, texto, kwargs, futuro, intento, False)))
+
+    def _diferir(self, espera: float, entrada: tuple):
+        """Devuelve `entrada` a la cola dentro de `espera` segundos (conserva su prioridad)."""
+        def reponer():
+            self._diferidos.discard(handle)
+            self._cola.put_nowait(entrada)
+        handle = asyncio.get_running_loop().call_later(espera, reponer)
+        self._diferidos.add(handle)
+
+    def _cubo_chat(self, chat_id) -> CuboTokens:
+        cubo = self._por_chat.get(chat_id)
+        if cubo is None:
+            if len(self._por_chat) > 5000:
+                self._por_chat = {c: b for c, b in self._por_chat.items() if not b.lleno()}
+            tasa = SALIDA_TASA_CHAT if int(chat_id) > 0 else SALIDA_TASA_GRUPO
+            cubo = self._por_chat[chat_id] = CuboTokens(tasa, 1)
+        return cubo
+
+    async def _worker(self):
+        while True:
+            entrada = await self._cola.get()
+            prioridad, seq, (metodo, chat_id, texto, kwargs, futuro, intento, con_turno) = entrada
+            try:
+                if not con_turno:
+                    turno = self._cubo_chat(chat_id).reservar()
+                    if turno > 0:
+                        # El chat no tiene turno ya: se aparta con su turno reservado y el
+                        # worker atiende al siguiente de la cola
+                        self.metricas["diferidos"] += 1
+                        self._diferir(turno, (prioridad, seq, (metodo, chat_id, texto, kwargs, futuro, intento, True)))
+                        continue
+                espera = max(self._pausa_hasta - monotonic(), self._global.reservar())
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                resultado = await getattr(self._bot, metodo)(chat_id=chat_id, **self._args(texto, kwargs))
+            except asyncio.CancelledError:
+                raise
+            except RetryAfter as e:
+                self.metricas["retry_after"] += 1
+                self._limitado(chat_id, e.retry_after)
+                self._reintentar(prioridad, metodo, chat_id, texto, kwargs, futuro, intento, e)
+            except (BadRequest, Forbidden) as e:
+                self._fallar(metodo, chat_id, futuro, e)
+            except NetworkError as e:
+                self._reintentar(prioridad, metodo, chat_id, texto, kwargs, futuro, intento, e,
+                                 espera=SALIDA_BACKOFF_S * 2 ** intento)
+            except Exception as e:
+                self._fallar(metodo, chat_id, futuro, e)
+            else:
+                self.metricas["enviados"] += 1
+                if futuro and not futuro.done():
+                    futuro.set_result(resultado)
+            finally:
+                self._cola.task_done()
+
+    def _limitado(self, chat_id, segundos: float):
+        """
+        RetryAfter: pausa el cubo de ese chat (el reintento se aparta hasta que termine) y
+        solo si varios chats lo reciben dentro de SALIDA_FLOOD_S, todos los envíos.
+        """
+        ahora = monotonic()
+        self._cubo_chat(chat_id).pausar(segundos)
+        self._retry_after_chats = {
+            c: t for c, t in self._retry_after_chats.items() if ahora - t <= SALIDA_FLOOD_S
+        }
+        self._retry_after_chats[chat_id] = ahora
+        if len(self._retry_after_chats) >= SALIDA_FLOOD_CHATS:
+            self._pausa_hasta = max(self._pausa_hasta, ahora + segundos)
+
+    def _reintentar(self, prioridad, metodo, chat_id, texto, kwargs, futuro, intento, error, espera: float = 0):
+        if intento >= SALIDA_REINTENTOS:
+            self._fallar(metodo, chat_id, futuro, error)
+            return
+        self.metricas["reintentos"] += 1
+        if espera > 0:
+            self._seq += 1
+            self._diferir(espera, (prioridad, self._seq, (metodo, chat_id, texto, kwargs, futuro, intento + 1, False)))
+            return
+        self._poner(prioridad, metodo, chat_id, texto, kwargs, futuro, intento + 1)
+
+    def _fallar(self, metodo, chat_id, futuro, error):
+        self.metricas["fallidos"] += 1
+        print(f"[SALIDA] {metodo} a {chat_id} falló: {error}")
+        if futuro and not futuro.done():
+            futuro.set_exception(error)
+
+
+COLA_SALIDA = ColaSalida(SALIDA_WORKERS)
+
+
+# --- Difusión a varios destinatarios ---
+
+DIFUSION_PARALELO = int(os.getenv("DIFUSION_PARALELO", "10"))
+_TAREAS_FONDO: set[asyncio.Task] = set()
+
+
+def en_fondo(coro) -> asyncio.Task:
+    """Lanza una corrutina sin esperarla, guardando referencia hasta que termine."""
+    t = asyncio.create_task(coro)
+    _TAREAS_FONDO.add(t)
+    t.add_done_callback(_TAREAS_FONDO.discard)
+    return t
+
+
+async def difundir(chat_ids, texto: str, prioridad: int = PRIORIDAD_ADMIN, **kwargs) -> dict:
+    """
+    Envía el mismo mensaje a varios chats en paralelo (máx. DIFUSION_PARALELO a la vez)
+    por la cola de salida. Retorna {chat_id: {"ok": True, "message_id"} | {"ok": False, "error"}}.
+    """
+    semaforo = asyncio.Semaphore(DIFUSION_PARALELO)
+
+    async def uno(chat_id):
+        async with semaforo:
+            try:
+                msg = await COLA_SALIDA.enviar(chat_id, texto, prioridad, **kwargs)
+                return chat_id, {"ok": True, "message_id": msg.message_id}
+            except Exception as e:
+                return chat_id, {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    return dict(await asyncio.gather(*(uno(c) for c in dict.fromkeys(chat_ids))))
+
+
+def difundir_en_fondo(etiqueta: str, chat_ids, texto: str, prioridad: int = PRIORIDAD_ADMIN, **kwargs):
+    """Lanza difundir() sin bloquear el handler y deja en el log los destinatarios que fallaron."""
+    async def tarea():
+        resultados = await difundir(chat_ids, texto, prioridad, **kwargs)
+        fallidos = {c: r["error"] for c, r in resultados.items() if not r["ok"]}
+        if fallidos:
+            print(f"[DIFUSION] {etiqueta}: {len(fallidos)}/{len(resultados)} fallaron: {fallidos}")
+        return resultados
+
+    return en_fondo(tarea())
+
+
+async def _publicar_en_canal(service_id: str, data: dict, texto: str):
+    canal_id = get_canal(normalizar_servicio(data.get("servicio", "")) or "")
+    if not canal_id:
+        return
+    for intento in range(SALIDA_REINTENTOS + 1):
+        try:
+            return await _publicar_en_canal_bloqueado(service_id, canal_id, data, texto)
+        except CandadoOcupado as e:
+            # Otro worker está publicando este servicio (espera turno en su cola de salida)
+            print(f"[CANAL] {service_id}: {e}; reintento {intento + 1}.")
+            await asyncio.sleep(BLOQUEO_REINTENTO_S)
+    print(f"[CANAL] {service_id}: no se pudo publicar (candado ocupado).")
+
+
+async def _publicar_en_canal_bloqueado(service_id: str, canal_id: int, data: dict, texto: str):
+    # Con varios workers el candado es distribuido: dos procesos no pueden ver a la vez
+    # canal_msg_id vacío y publicar cada uno un mensaje nuevo
+    async with _CANDADOS_CANAL.bloquear(service_id):
+        msg_id = data.get("canal_msg_id")
+        if not msg_id:
+            # Puede que la publicación anterior haya terminado después de leer `data`
+            msg_id = ((await get_service_async(service_id)) or {}).get("canal_msg_id")
+        if msg_id:
+            try:
+                await COLA_SALIDA.enviar(
+                    canal_id, texto, PRIORIDAD_CANAL,
+                    metodo="edit_message_text", message_id=msg_id, parse_mode="Markdown",
+                )
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+            except Exception:
+                pass
+            # No se pudo editar (borrado, muy viejo...): se publica de nuevo
+        try:
+            msg = await COLA_SALIDA.enviar(canal_id, texto, PRIORIDAD_CANAL, parse_mode="Markdown")
+        except Exception as e:
+            print(f"[CANAL] {service_id}: no se pudo publicar: {e}")
+            return
+        await update_service_async(service_id, canal_msg_id=msg.message_id)
+
+
+def publicar_en_canal(service_id: str, data: dict, texto: str):
+    """
+    Refleja el estado del servicio en su canal: edita la publicación guardada en
+    data["canal_msg_id"] y solo publica un mensaje nuevo la primera vez o si la edición falla.
+    """
+    return en_fondo(_publicar_en_canal(service_id, data, texto))
+
+
+# --- Oyente de avisos de otros procesos ---
+
+class OyenteCambios:
+    """
+    Conexión dedicada (fuera del pool) con LISTEN CAMBIOS_CANAL, leída desde el event loop
+    con add_reader: sin consultas periódicas. Aplica los avisos de otros procesos a la
+    caché de móviles / índice y quita temporizadores de ofertas que otro proceso resolvió.
+    Si la conexión se cae, invalida la caché (pudo perder avisos) y reconecta. Tras cada
+    conexión relee los móviles: lo que cambió mientras no escuchaba llega también al índice.
+    """
+
+    REINTENTO_S = 5
+
+    def __init__(self, dsn: str):
+        self._dsn      = dsn
+        self._conn     = None
+        self._loop     = None
+        self._app      = None
+        self._reintento = None
+        self.metricas  = {"avisos": 0, "reconexiones": 0}
+
+    async def iniciar(self, application):
+        self._app  = application
+        self._loop = asyncio.get_running_loop()
+        await self._conectar()
+
+    def _abrir(self):
+        conn = psycopg2.connect(self._dsn)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {CAMBIOS_CANAL}")
+        return conn
+
+    async def _conectar(self):
+        self._reintento = None
+        try:
+            conn = await self._loop.run_in_executor(_DB_EXECUTOR, self._abrir)
+        except psycopg2.Error as e:
+            print(f"[CAMBIOS] No se pudo escuchar avisos: {e}. Reintento en {self.REINTENTO_S} s.")
+            self._programar_reconexion()
+            return
+        self._conn = conn
+        self._loop.add_reader(conn.fileno(), self._leer)
+        print(f"[CAMBIOS] Escuchando {CAMBIOS_CANAL} (proceso {PROCESO_ID}).")
+        # Ya escuchando: recargar cubre los avisos perdidos antes de este LISTEN
+        try:
+            await run_db(recargar_mobiles)
+        except Exception as e:
+            print(f"[CAMBIOS] No se pudo recargar móviles tras conectar: {e}")
+
+    def _programar_reconexion(self):
+        self._reintento = self._loop.call_later(self.REINTENTO_S, lambda: en_fondo(self._conectar()))
+
+    def _cerrar(self):
+        if self._conn is not None:
+            try:
+                self._loop.remove_reader(self._conn.fileno())
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _leer(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            print(f"[CAMBIOS] Conexión de avisos perdida: {e}")
+            self._cerrar()
+            CACHE_MOVILES.invalidar()  # pudimos perder avisos: la próxima lectura recarga
+            self.metricas["reconexiones"] += 1
+            self._programar_reconexion()
+            return
+        while self._conn.notifies:
+            aviso = self._conn.notifies.pop(0)
             try:
-                numeros.append(int(codigo[len(prefijo):]))
+                cambio = json.loads(aviso.payload)
             except ValueError:
                 continue
-    next_num = max(numeros) + 1 if numeros else 1
-    return f"{prefijo}{next_num:03d}"
+            if cambio.get("o") == PROCESO_ID:
+                continue
+            self.metricas["avisos"] += 1
+            en_fondo(self._aplicar(cambio.get("t"), cambio.get("ids")))
+
+    async def _aplicar(self, tabla: str, ids):
+        try:
+            if tabla == "mobiles":
+                if ids is None:
+                    await run_db(recargar_mobiles)
+                else:
+                    await run_db(refrescar_mobiles, ids)
+            elif tabla == "services" and ids:
+                job_queue = self._app.job_queue
+                for service_id in ids:
+                    if job_queue is None or not job_queue.get_jobs_by_name(_nombre_job_oferta(service_id)):
+                        continue
+                    data = await get_service_async(service_id)
+                    if not data or data.get("status") != "pendiente":
+                        cancelar_timeout_oferta(job_queue, service_id)
+        except Exception as e:
+            print(f"[CAMBIOS] Error aplicando aviso de {tabla}: {e}")
+
+    async def detener(self):
+        if self._reintento is not None:
+            self._reintento.cancel()
+        self._cerrar()
+
+
+OYENTE_CAMBIOS = OyenteCambios(DATABASE_URL)
+
+
+# --- Estado de conversación compartido ---
+
+def _leer_estados() -> dict:
+    """{user_id: (datos, actualizado)} de los usuarios con estado no vacío."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id, datos, actualizado FROM estado_usuarios WHERE datos <> '{}'::jsonb")
+        return {user_id: (datos, actualizado) for user_id, datos, actualizado in cur.fetchall()}
+
+
+def _leer_estado(user_id: int, despues_de) -> tuple | None:
+    """(datos, actualizado) del usuario solo si cambió después de `despues_de` (None = siempre)."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT datos, actualizado FROM estado_usuarios
+            WHERE user_id = %s AND actualizado > COALESCE(%s, '-infinity'::timestamptz)
+        """, (user_id, despues_de))
+        return cur.fetchone()
+
+
+def _guardar_estado(user_id: int, datos: dict):
+    """Guarda el estado y retorna su marca `actualizado`. Vacío se guarda como {} (no se borra)."""
+    with get_db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO estado_usuarios (user_id, datos, actualizado)
+            VALUES (%s, %s, now())
+            ON CONFLICT (user_id) DO UPDATE
+                SET datos = EXCLUDED.datos, actualizado = EXCLUDED.actualizado
+            RETURNING actualizado
+        """, (user_id, json.dumps(datos, ensure_ascii=False, default=str)))
+        return cur.fetchone()[0]
+
+
+class PersistenciaPostgres(BasePersistence):
+    """
+    Guarda context.user_data (paso del flujo, datos parciales de la solicitud, registro
+    de móvil...) en la tabla estado_usuarios. Así la conversación sobrevive a reinicios
+    y a que otro worker tome el chat (ej: al cambiar WORKERS). Solo persiste user_data:
+    chat_data, bot_data y conversaciones no se usan en este bot.
+
+    Antes de cada update se relee la fila del usuario, pero solo se aplica si otro proceso
+    la escribió después de la última versión que este conoce (`actualizado`): los cambios
+    propios aún sin guardar (cada ESTADO_INTERVALO_S) no se pisan con la copia vieja.
+    """
+
+    def __init__(self, intervalo: float = ESTADO_INTERVALO_S):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=intervalo,
+        )
+        self._versiones: dict[int, datetime] = {}   # user_id -> último `actualizado` leído o escrito
+
+    async def get_user_data(self) -> dict:
+        estados = await run_db(_leer_estados)
+        self._versiones = {uid: actualizado for uid, (_, actualizado) in estados.items()}
+        return {uid: datos for uid, (datos, _) in estados.items()}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._versiones[user_id] = await run_db(_guardar_estado, user_id, dict(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._versiones[user_id] = await run_db(_guardar_estado, user_id, {})
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        fila = await run_db(_leer_estado, user_id, self._versiones.get(user_id))
+        if fila is None:
+            return
+        datos, self._versiones[user_id] = fila
+        user_data.clear()
+        user_data.update(datos)
+
+    # Lo que no se persiste
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
 
 
 # ============================================================
@@ -473,6 +2525,7 @@ def build_admin_keyboard() -> ReplyKeyboardMarkup:
             [KeyboardButton("🗑 Eliminar móvil")],
             [KeyboardButton("💰 Aprobar pagos")],
             [KeyboardButton("📋 Ver servicios activos")],
+            [KeyboardButton("📍 Móviles cercanos a un servicio")],
             [KeyboardButton("⬅ Volver al inicio")],
         ],
         resize_keyboard=True,
@@ -515,114 +2568,524 @@ def build_location_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def build_registro_servicio_keyboard() -> ReplyKeyboardMarkup:
-    """
-    Teclado para que el admin elija el servicio al registrar un móvil.
-    Generado dinámicamente desde SERVICIOS para que siempre esté sincronizado.
-    """
-    botones = []
-    for clave, info in SERVICIOS.items():
-        botones.append([KeyboardButton(f"{info['emoji']} {info['nombre']}")])
-    return ReplyKeyboardMarkup(botones, resize_keyboard=True, one_time_keyboard=True)
+def build_registro_servicio_keyboard() -> ReplyKeyboardMarkup:
+    """
+    Teclado para que el admin elija el servicio al registrar un móvil.
+    Generado dinámicamente desde SERVICIOS para que siempre esté sincronizado.
+    """
+    botones = []
+    for clave, info in SERVICIOS.items():
+        botones.append([KeyboardButton(f"{info['emoji']} {info['nombre']}")])
+    return ReplyKeyboardMarkup(botones, resize_keyboard=True, one_time_keyboard=True)
+
+
+# ============================================================
+# 6. HANDLERS - /start y /soy_movil
+# ============================================================
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+    await update.message.reply_text(
+        "👋 Bienvenido a *PRONTO*\n\n¿Cómo deseas continuar?",
+        parse_mode="Markdown",
+        reply_markup=build_main_keyboard(),
+    )
+
+
+async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await deny_admin_access(update, context)
+        return
+
+    context.user_data.clear()
+    context.user_data["mode"]       = "admin"
+    context.user_data["admin_step"] = None
+
+    await update.message.reply_text(
+        "👮 Panel de administración\n\nElige una opción:",
+        reply_markup=build_admin_keyboard(),
+    )
+
+
+async def soy_movil_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user    = update.effective_user
+    chat_id = update.effective_chat.id
+
+    await update.message.reply_text(
+        "✅ Tu solicitud fue enviada.\n"
+        "El administrador te registrará pronto para que puedas empezar a trabajar."
+    )
+
+    nombre   = user.full_name or "Sin nombre"
+    username = f"@{user.username}" if user.username else "Sin username"
+
+    texto_admin = (
+        "📲 *Nuevo conductor quiere registrarse*\n\n"
+        f"👤 Nombre: *{nombre}*\n"
+        f"🔗 Usuario: {username}\n"
+        f"💬 Chat ID: `{chat_id}`\n\n"
+        "¿Deseas iniciar el registro de este móvil ahora?"
+    )
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("📝 Iniciar registro", callback_data=f"REG_MOVIL|{chat_id}")]]
+    )
+
+    difundir_en_fondo("soy_movil", ADMIN_IDS, texto_admin, parse_mode="Markdown", reply_markup=keyboard)
+
+
+# ============================================================
+# 7. HANDLERS - USUARIO (flujo de solicitud de servicio)
+# ============================================================
+
+async def handle_cliente_option(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["mode"] = "usuario"
+    context.user_data["step"] = "choose_service"
+    await update.message.reply_text(
+        "Selecciona el tipo de servicio que necesitas:",
+        reply_markup=build_user_service_keyboard(),
+    )
+
+
+async def handle_usuario_service_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, clave_servicio: str):
+    """
+    El cliente eligió un servicio. Guarda la CLAVE INTERNA, no el nombre.
+    """
+    context.user_data["mode"]     = "usuario"
+    context.user_data["step"]     = "ask_name"
+    context.user_data["servicio"] = clave_servicio  # ← siempre clave interna
+    context.user_data["data"]     = {}
+    await update.message.reply_text(
+        "📝 Por favor escribe tu *nombre completo*:",
+        parse_mode="Markdown",
+    )
+
+
+# --- Ofertas a móviles ---
+#
+# Un servicio pendiente se ofrece a la vez a los OFERTA_MOVILES móviles elegibles más
+# cercanos. Todos reciben el botón RESERVAR; el primero que lo toque se lo lleva
+# (compare-and-set en la BD) y a los demás se les edita el mensaje como "tomado".
+
+OFERTA_MOVILES = max(1, int(os.getenv("OFERTA_MOVILES", "1")))
+
+# Si nadie reserva en OFERTA_TIMEOUT_S, la oferta se retira y pasa a los siguientes móviles
+# más cercanos (sin repetir a quienes rechazaron o dejaron vencer). Tras OFERTA_MAX_SALTOS
+# rondas sin éxito se avisa a los admins (OFERTA_ESCALAR_ADMINS).
+OFERTA_TIMEOUT_S      = float(os.getenv("OFERTA_TIMEOUT_S", "60"))
+OFERTA_MAX_SALTOS     = int(os.getenv("OFERTA_MAX_SALTOS", "3"))
+OFERTA_ESCALAR_ADMINS = os.getenv("OFERTA_ESCALAR_ADMINS", "1") not in ("0", "false", "no")
+
+
+def _texto_oferta(service_id: str, data: dict, hora: str) -> str:
+    """Mensaje que recibe un móvil cuando se le ofrece un servicio."""
+    clave_servicio = normalizar_servicio(data.get("servicio", "")) or ""
+    nombre_srv     = get_nombre_corto(clave_servicio) if clave_servicio else "?"
+    texto  = f"🚨 *Nuevo servicio de {nombre_srv}*\n\n"
+    texto += f"🆔 Código de servicio: *{service_id}*\n"
+    texto += f"👤 Cliente: *{data.get('nombre', '(sin nombre)')}*\n"
+    texto += f"📞 Teléfono cliente: *{data.get('telefono', '(sin teléfono)')}*\n"
+    texto += f"📍 Destino: *{data.get('destino', '(sin destino)')}*\n"
+    if clave_servicio == "camionetas":
+        texto += f"📦 Tipo de carga: *{data.get('carga', '(no especificada)')}*\n"
+    if data.get("lat") is not None and data.get("lon") is not None:
+        texto += "\n🌎 El cliente compartió ubicación GPS.\n"
+    texto += f"\n⏰ Hora: *{hora}* (Colombia)\n\nPresiona el botón para tomar el servicio."
+    return texto
+
+
+async def buscar_candidatos_oferta(data: dict, excluir=()) -> list[dict]:
+    """Móviles elegibles (con cupo, libres primero) más cercanos, hasta OFERTA_MOVILES."""
+    clave_servicio = normalizar_servicio(data.get("servicio", ""))
+    if not clave_servicio:
+        return []
+    return await seleccionar_moviles_disponibles_async(
+        clave_servicio, data.get("lat"), data.get("lon"),
+        k=OFERTA_MOVILES, radio_km=DESPACHO_RADIO_KM, excluir=excluir,
+    )
+
+
+class LoteDespacho:
+    """
+    Junta las solicitudes nuevas de cada clave durante `ventana_s` y las asigna en bloque
+    (ver asignar_lote). Si OFERTA_MOVILES > 1, el resto de la ronda se completa con los
+    más cercanos que no fueron asignados a otra solicitud del mismo lote.
+    """
+
+    def __init__(self, ventana_s: float):
+        self._ventana    = ventana_s
+        self._pendientes: dict[str, list] = {}
+
+    async def candidatos(self, data: dict) -> list[dict]:
+        clave = normalizar_servicio(data.get("servicio", ""))
+        if not clave or data.get("lat") is None or data.get("lon") is None:
+            return await buscar_candidatos_oferta(data)
+        futuro = asyncio.get_running_loop().create_future()
+        lote = self._pendientes.setdefault(clave, [])
+        lote.append((data, futuro))
+        if len(lote) == 1:
+            en_fondo(self._resolver(clave))
+        return await futuro
+
+    async def _resolver(self, clave: str):
+        await asyncio.sleep(self._ventana)
+        lote = self._pendientes.pop(clave, [])
+        try:
+            asignados, metricas = await asignar_lote_async(clave, [d for d, _ in lote])
+            for campo, valor in metricas.items():
+                METRICAS_LOTE[campo] += valor
+            METRICAS_LOTE["lotes"] += 1
+            if len(lote) > 1:
+                print(
+                    f"[LOTE] {clave}: {metricas['asignadas']}/{len(lote)} asignadas, "
+                    f"{metricas['km_optimo']:.2f} km (voraz {metricas['km_voraz']:.2f} km)"
+                )
+
+            tomados = {str(a["chat_id"]) for a in asignados if a}
+
+            async def completar(data, asignado):
+                if asignado and OFERTA_MOVILES <= 1:
+                    return [asignado]
+                excluir = tomados | {str(c) for c in data.get("descartados") or ()}
+                extra = await buscar_candidatos_oferta(data, excluir=excluir)
+                return ([asignado] if asignado else []) + extra[:OFERTA_MOVILES - bool(asignado)]
+
+            listas = await asyncio.gather(*(completar(d, a) for (d, _), a in zip(lote, asignados)))
+            for (_, futuro), lista in zip(lote, listas):
+                if not futuro.done():
+                    futuro.set_result(lista)
+        except Exception as e:
+            print(f"[LOTE] Error asignando lote de {clave}: {e}")
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+
+
+LOTE_DESPACHO = LoteDespacho(DESPACHO_LOTE_MS / 1000) if DESPACHO_LOTE_MS > 0 else None
+
+
+def _vence_oferta() -> float:
+    """`oferta_vence` de una ronda que empieza ahora: respaldo del temporizador en la BD (ver revisar_cola)."""
+    return now_colombia().timestamp() + OFERTA_TIMEOUT_S
+
+
+def _nombre_job_oferta(service_id: str) -> str:
+    return f"oferta:{service_id}"
+
+
+def cancelar_timeout_oferta(job_queue, service_id: str):
+    """Quita el temporizador de la oferta vigente del servicio (si hay)."""
+    if job_queue is None:
+        return
+    for job in job_queue.get_jobs_by_name(_nombre_job_oferta(service_id)):
+        job.schedule_removal()
+
+
+async def ofertar_servicio(context, service_id: str, data: dict, candidatos: list[dict]) -> dict:
+    """
+    Abre una nueva ronda de ofertas: ofrece el servicio a todos los candidatos en paralelo
+    y programa su vencimiento (OFERTA_TIMEOUT_S) en el JobQueue. El vencimiento también
+    queda en la BD (`oferta_vence`) por si el temporizador se pierde con un reinicio.
+    Registra primero a quién se ofreció (para que un toque rápido ya sea válido) y guarda
+    el message_id de cada oferta apenas se entrega, así el móvil que reserve puede retirar
+    las demás aunque otras sigan en camino. Retorna {chat_id: {"codigo", "message_id"}}
+    solo con las ofertas que sí se entregaron; si no se entregó ninguna, el servicio pasa
+    a la cola de espera sin temporizador.
+    """
+    ronda   = int(data.get("ronda") or 0) + 1
+    ofertas = {str(c["chat_id"]): {"codigo": c["codigo"], "message_id": None} for c in candidatos}
+    data["ronda"], data["ofertas"], data["oferta_vence"] = ronda, ofertas, _vence_oferta()
+    await update_service_async(service_id, ofertas=ofertas, ronda=ronda, oferta_vence=data["oferta_vence"])
+
+    texto    = _texto_oferta(service_id, data, now_colombia_str())
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🚨🔴 RESERVAR SERVICIO 🔴🚨", callback_data=f"RESERVAR|{service_id}")],
+        [InlineKeyboardButton("❌ Rechazar",                 callback_data=f"RECHAZAR|{service_id}")],
+    ])
+
+    async def entregar(c):
+        msg = await COLA_SALIDA.enviar(
+            c["chat_id"], texto, PRIORIDAD_OFERTA, reply_markup=keyboard, parse_mode="Markdown"
+        )
+        if not await registrar_mensaje_oferta_async(service_id, ronda, c["chat_id"], msg.message_id):
+            # La ronda se cerró mientras se enviaba: nadie más sabe de este mensaje
+            actual = await get_service_async(service_id) or {}
+            if actual.get("status") == "reservado" and str(actual.get("movil_chat_id")) == str(c["chat_id"]):
+                return msg  # lo reservó este mismo móvil
+            if actual.get("status") == "pendiente" and int(actual.get("ronda") or 0) == ronda:
+                return msg  # la ronda sigue: este móvil la rechazó y ya se le editó el mensaje
+            texto_retiro = (
+                "⛔ Este servicio ya fue tomado por otro móvil." if actual.get("status") == "reservado"
+                else "⌛ Esta oferta ya no está vigente."
+            )
+            retirar_ofertas({str(c["chat_id"]): {"message_id": msg.message_id}}, texto=texto_retiro)
+        return msg
+
+    resultados = await asyncio.gather(*(entregar(c) for c in candidatos), return_exceptions=True)
+    entregadas = {}
+    for c, res in zip(candidatos, resultados):
+        if isinstance(res, Exception):
+            print(f"[OFERTA] {service_id}: no se pudo notificar a {c['codigo']}: {res}")
+            continue
+        entregadas[str(c["chat_id"])] = {"codigo": c["codigo"], "message_id": res.message_id}
+    data["ofertas"] = {**ofertas, **entregadas}
+    if not entregadas:
+        # Ningún móvil recibió la oferta: que la tome el próximo que quede libre
+        await devolver_a_cola(service_id, data)
+        return entregadas
+    # El plazo corre desde la entrega, como el temporizador
+    data["oferta_vence"] = _vence_oferta()
+    await update_service_async(
+        service_id, si={"status": "pendiente", "ronda": ronda}, oferta_vence=data["oferta_vence"]
+    )
+
+    job_queue = context.job_queue
+    if job_queue is not None:
+        cancelar_timeout_oferta(job_queue, service_id)
+        job_queue.run_once(
+            _oferta_vencida,
+            OFERTA_TIMEOUT_S,
+            data={"service_id": service_id, "ronda": ronda},
+            name=_nombre_job_oferta(service_id),
+        )
+    return entregadas
+
+
+def retirar_ofertas(ofertas: dict, excepto=None, texto: str = "⛔ Este servicio ya fue tomado por otro móvil."):
+    """Edita los mensajes de oferta de los móviles (menos `excepto`) para que no intenten reservar."""
+    for cid, o in (ofertas or {}).items():
+        if o.get("message_id") and cid != str(excepto):
+            COLA_SALIDA.encolar(
+                int(cid), texto, PRIORIDAD_OFERTA, metodo="edit_message_text", message_id=o["message_id"]
+            )
+
+
+def escalar_a_admins(service_id: str, data: dict, motivo: str):
+    """Avisa a los admins que un servicio quedó sin móvil."""
+    if not OFERTA_ESCALAR_ADMINS:
+        return
+    clave = normalizar_servicio(data.get("servicio", "")) or ""
+    texto = (
+        f"⚠️ *Servicio sin móvil*\n\n"
+        f"🆔 Servicio: *{service_id}*\n"
+        f"🚗 Tipo: *{get_nombre_corto(clave) if clave else '?'}*\n"
+        f"👤 Cliente: {data.get('nombre','')}\n"
+        f"📞 Tel: {data.get('telefono','')}\n"
+        f"📍 Destino: {data.get('destino','')}\n"
+        f"❗ {motivo}"
+    )
+    difundir_en_fondo(f"escalar {service_id}", ADMIN_IDS, texto, parse_mode="Markdown")
+
+
+async def siguiente_ronda(context, service_id: str, ronda: int, motivo: str,
+                          texto_retiro: str = "⌛ La oferta venció y pasó a otro móvil."):
+    """
+    Cierra la ronda `ronda` de un servicio pendiente: los móviles a los que seguía ofrecido
+    pasan a "descartados", se retiran sus ofertas y el servicio se ofrece a los siguientes
+    móviles más cercanos. No hace nada si ya fue reservado o la ronda ya cambió.
+    """
+    async with _CANDADOS_SERVICIO.bloquear(service_id):
+        data = await get_service_async(service_id)
+        if not data or data.get("status") != "pendiente" or int(data.get("ronda") or 0) != ronda:
+            return
+        ofertas     = data.get("ofertas") or {}
+        descartados = list(dict.fromkeys([*(data.get("descartados") or []), *ofertas]))
+        saltos      = int(data.get("saltos") or 0) + 1
+        data = await update_service_async(
+            service_id,
+            si={"status": "pendiente", "ronda": ronda},
+            ofertas={},
+            descartados=descartados,
+            saltos=saltos,
+            movil_codigo=None,
+            movil_chat_id=None,
+        )
+        if not data:
+            return  # otro proceso lo reservó en el intermedio
+
+    cancelar_timeout_oferta(context.job_queue, service_id)
+    retirar_ofertas(ofertas, texto=texto_retiro)
+    print(f"[OFERTA] {service_id}: ronda {ronda} cerrada ({motivo}).")
+
+    if saltos > OFERTA_MAX_SALTOS:
+        escalar_a_admins(service_id, data, f"Nadie lo reservó tras {saltos} rondas de ofertas.")
+        # Queda en la cola: se despacha si llega un móvil libre o vence y se avisa al cliente
+        await devolver_a_cola(service_id, data)
+        return
+    candidatos = await buscar_candidatos_oferta(data, excluir=descartados)
+    if not candidatos:
+        # Nadie más cerca ahora: vuelve a la cola y se despacha cuando llegue un móvil
+        await devolver_a_cola(service_id, data)
+        return
+    await ofertar_servicio(context, service_id, data, candidatos)
+
+
+async def _oferta_vencida(context: ContextTypes.DEFAULT_TYPE):
+    """Job: nadie reservó a tiempo; retira la oferta y la pasa a los siguientes móviles."""
+    job = context.job
+    try:
+        await siguiente_ronda(context, job.data["service_id"], job.data["ronda"], "oferta vencida")
+    except CandadoOcupado as e:
+        # Otro proceso tiene el servicio: reintentar en vez de dejar la ronda abierta
+        print(f"[OFERTA] {job.data['service_id']}: {e}; reintento en {BLOQUEO_REINTENTO_S:g}s.")
+        context.job_queue.run_once(_oferta_vencida, BLOQUEO_REINTENTO_S, data=job.data, name=job.name)
 
 
-# ============================================================
-# 6. HANDLERS - /start y /soy_movil
-# ============================================================
+# --- Cola de espera ---
+#
+# Si no hay móvil disponible, la solicitud no se pierde: queda "en_espera" en la BD y se
+# despacha sola cuando un móvil inicia jornada o comparte ubicación (la más antigua
+# primero; entre las que llegaron con menos de COLA_EMPATE_S de diferencia, la más
+# cercana al móvil). Vence a los COLA_EXPIRA_MIN minutos y se avisa al cliente.
+
+COLA_EXPIRA_MIN = float(os.getenv("COLA_EXPIRA_MIN", "30"))
+COLA_EMPATE_S   = float(os.getenv("COLA_EMPATE_S", "60"))
+COLA_REVISION_S = float(os.getenv("COLA_REVISION_S", "60"))
+COLA_LOTE       = 20   # solicitudes más antiguas que se evalúan por despacho
+
+
+def _marcas_cola(data: dict) -> dict:
+    """Campos de cola (conserva la antigüedad original si ya estuvo en espera)."""
+    ahora = now_colombia().timestamp()
+    desde = data.get("en_espera_ts") or ahora
+    return {
+        "status":       "en_espera",
+        "en_espera_ts": desde,
+        "expira_ts":    desde + COLA_EXPIRA_MIN * 60,
+        "ofertas":      {},
+    }
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
-    await update.message.reply_text(
-        "👋 Bienvenido a *PRONTO*\n\n¿Cómo deseas continuar?",
-        parse_mode="Markdown",
-        reply_markup=build_main_keyboard(),
-    )
 
+async def devolver_a_cola(service_id: str, data: dict) -> dict | None:
+    """Pasa un servicio pendiente sin candidatos a la cola de espera."""
+    return await update_service_async(service_id, si={"status": "pendiente"}, **_marcas_cola(data))
 
-async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if not is_admin(user_id):
-        await deny_admin_access(update, context)
-        return
 
-    context.user_data.clear()
-    context.user_data["mode"]       = "admin"
-    context.user_data["admin_step"] = None
+async def despachar_cola_para_movil(context, user_id: str) -> str | None:
+    """
+    Un móvil quedó disponible (inició jornada o compartió ubicación): le ofrece la
+    solicitud en espera que le corresponde, si hay. Retorna el service_id ofrecido.
+    """
+    m = INDICE_FLOTA.obtener(user_id)
+    if not m or not mobile_can_work(m)[0]:
+        return None
+    clave = m["servicio"]
+    # Las ofertas aún abiertas cuentan: cada ubicación compartida no debe sumarle otra
+    carga = (await carga_moviles_async([user_id], incluir_ofertas=True)).get(str(user_id), 0)
+    if carga >= get_capacidad(clave):
+        return None
 
-    await update.message.reply_text(
-        "👮 Panel de administración\n\nElige una opción:",
-        reply_markup=build_admin_keyboard(),
-    )
+    en_espera = await servicios_en_espera_async(clave, COLA_LOTE)
+    if not en_espera:
+        return None
 
+    # Más antigua primero; entre "empatadas" por antigüedad, la más cercana al móvil
+    t0 = float(en_espera[0]["en_espera_ts"])
 
-async def soy_movil_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user    = update.effective_user
-    chat_id = update.effective_chat.id
+    def distancia(s):
+        if None in (m.get("lat"), m.get("lon"), s.get("lat"), s.get("lon")):
+            return float("inf")
+        return haversine_distance(m["lat"], m["lon"], s["lat"], s["lon"])
 
-    await update.message.reply_text(
-        "✅ Tu solicitud fue enviada.\n"
-        "El administrador te registrará pronto para que puedas empezar a trabajar."
-    )
+    empatadas = [s for s in en_espera if float(s["en_espera_ts"]) - t0 <= COLA_EMPATE_S]
+    orden     = sorted(empatadas, key=distancia) + en_espera[len(empatadas):]
 
-    nombre   = user.full_name or "Sin nombre"
-    username = f"@{user.username}" if user.username else "Sin username"
+    for s in orden:
+        if str(user_id) in (s.get("descartados") or []):
+            continue
+        service_id = s["id"]
+        try:
+            async with _CANDADOS_SERVICIO.bloquear(service_id):
+                data = await update_service_async(
+                    service_id, si={"status": "en_espera"}, status="pendiente", oferta_vence=_vence_oferta()
+                )
+        except CandadoOcupado as e:
+            print(f"[COLA] {service_id}: {e}; se prueba la siguiente.")
+            continue
+        if not data:
+            continue  # otro móvil/proceso la tomó primero
+        candidato = {"chat_id": int(user_id), "codigo": m.get("codigo"), "servicio": clave, "distancia": distancia(s)}
+        if not await ofertar_servicio(context, service_id, data, [candidato]):
+            return None  # no se le pudo entregar: ofertar_servicio la devolvió a la cola
+        COLA_SALIDA.encolar(
+            data.get("user_chat_id"),
+            f"🚗 ¡Encontramos un móvil para tu solicitud *{service_id}*!\n"
+            "Estamos esperando su confirmación.",
+            PRIORIDAD_CLIENTE,
+            parse_mode="Markdown",
+        )
+        return service_id
+    return None
 
-    texto_admin = (
-        "📲 *Nuevo conductor quiere registrarse*\n\n"
-        f"👤 Nombre: *{nombre}*\n"
-        f"🔗 Usuario: {username}\n"
-        f"💬 Chat ID: `{chat_id}`\n\n"
-        "¿Deseas iniciar el registro de este móvil ahora?"
-    )
-    keyboard = InlineKeyboardMarkup(
-        [[InlineKeyboardButton("📝 Iniciar registro", callback_data=f"REG_MOVIL|{chat_id}")]]
-    )
 
-    for admin_id in ADMIN_IDS:
+async def revisar_cola(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job periódico: vence las solicitudes que llevan demasiado en espera y avisa al cliente.
+    También pasa de ronda las ofertas vencidas cuyo temporizador se perdió (reinicio,
+    despliegue o cambio en el número de workers).
+    """
+    ahora = now_colombia().timestamp()
+    for service_id, ronda in await ofertas_vencidas_async(ahora):
         try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=texto_admin,
-                parse_mode="Markdown",
-                reply_markup=keyboard,
-            )
-        except Exception:
-            pass
+            await siguiente_ronda(context, service_id, ronda, "oferta vencida (revisión)")
+        except Exception as e:
+            print(f"[OFERTA] {service_id}: no se pudo pasar de ronda: {e}")
+    for data in await expirar_cola_async(ahora):
+        print(f"[COLA] {data.get('id')}: solicitud en espera vencida.")
+        COLA_SALIDA.encolar(
+            data.get("user_chat_id"),
+            f"😔 No encontramos un móvil disponible para tu solicitud {data.get('id')}.\n"
+            "Por favor intenta de nuevo en unos minutos.",
+            PRIORIDAD_CLIENTE,
+        )
 
 
-# ============================================================
-# 7. HANDLERS - USUARIO (flujo de solicitud de servicio)
-# ============================================================
+async def recargar_mobiles_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: recarga la caché de móviles y el índice de la flota (red de seguridad del TTL)."""
+    try:
+        await run_db(recargar_mobiles)
+    except Exception as e:
+        print(f"[MOVILES] No se pudo recargar la caché: {e}")
 
-async def handle_cliente_option(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["mode"] = "usuario"
-    context.user_data["step"] = "choose_service"
-    await update.message.reply_text(
-        "Selecciona el tipo de servicio que necesitas:",
-        reply_markup=build_user_service_keyboard(),
-    )
 
+async def archivar_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: pasa al histórico los servicios terminados hace más de ARCHIVO_DIAS."""
+    movidos = await archivar_servicios_async()
+    if movidos:
+        print(f"[ARCHIVO] {movidos} servicios terminados movidos a services_archivo.")
 
-async def handle_usuario_service_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, clave_servicio: str):
-    """
-    El cliente eligió un servicio. Guarda la CLAVE INTERNA, no el nombre.
-    """
-    context.user_data["mode"]     = "usuario"
-    context.user_data["step"]     = "ask_name"
-    context.user_data["servicio"] = clave_servicio  # ← siempre clave interna
-    context.user_data["data"]     = {}
-    await update.message.reply_text(
-        "📝 Por favor escribe tu *nombre completo*:",
+
+def _codigos_ofertados(data: dict) -> str:
+    return ", ".join(o.get("codigo") or "?" for o in (data.get("ofertas") or {}).values())
+
+
+def avisar_en_espera(service_id: str, data: dict):
+    """Avisa al cliente y al canal que la solicitud quedó en la cola de espera."""
+    clave = normalizar_servicio(data.get("servicio", "")) or ""
+    COLA_SALIDA.encolar(
+        data.get("user_chat_id"),
+        "😔 En este momento no hay móviles disponibles para este servicio.\n"
+        f"Tu solicitud *{service_id}* quedó en espera: te avisaremos apenas un móvil la tome "
+        f"(vence en {COLA_EXPIRA_MIN:g} minutos).",
+        PRIORIDAD_CLIENTE,
         parse_mode="Markdown",
     )
+    publicar_en_canal(
+        service_id, data,
+        f"⏳ *Servicio en espera de móvil ({get_nombre_corto(clave) if clave else '?'})*\n"
+        f"🆔 Servicio: *{service_id}*\n"
+        f"📍 Destino: *{data.get('destino','')}*\n"
+        f"🕒 Hora: *{data.get('hora','')}* (Colombia)\n"
+        "Se asignará al primer móvil que inicie jornada.",
+    )
 
 
 async def finalize_user_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Completa la solicitud del usuario:
-    - Genera ID de servicio único.
-    - Busca el móvil más cercano usando clave interna.
-    - Notifica al móvil y publica en el canal correspondiente.
+    - Busca los móviles más cercanos usando clave interna.
+    - Genera ID de servicio único (secuencia de la BD).
+    - Ofrece el servicio a esos móviles y publica en el canal correspondiente.
     """
     user    = update.effective_user
     chat_id = update.effective_chat.id
@@ -637,97 +3100,73 @@ async def finalize_user_request(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Ocurrió un problema. Intenta de nuevo.")
         return
 
-    hora         = now_colombia_str()
-    nombre_srv   = get_nombre_corto(clave_servicio)
+    hora = now_colombia_str()
 
     data["hora"]         = hora
     data["servicio"]     = clave_servicio      # ← clave interna en el registro
     data["user_chat_id"] = chat_id
     data["user_id"]      = user.id
 
-    # Generar ID único de servicio
-    services = get_services()
-    nums = []
-    for sid in services:
-        if isinstance(sid, str) and sid.startswith("S"):
-            try:
-                nums.append(int(sid[1:]))
-            except ValueError:
-                pass
-    service_id = f"S{(max(nums) + 1 if nums else 1):05d}"
-
-    data["id"]            = service_id
+    # El móvil queda asignado solo cuando reserva; mientras tanto el servicio guarda las ofertas
     data["status"]        = "pendiente"
     data["movil_codigo"]  = None
     data["movil_chat_id"] = None
-
-    # Buscar móvil más cercano (con clave interna)
-    movil_info = seleccionar_movil_mas_cercano(clave_servicio, data.get("lat"), data.get("lon"))
-    if movil_info is None:
-        await update.message.reply_text(
-            "😔 En este momento no hay móviles disponibles para este servicio.\n"
-            "Por favor intenta en unos minutos."
-        )
+    data["ofertas"]       = {}
+    data["oferta_vence"]  = _vence_oferta()
+
+    # Buscar móviles más cercanos (con clave interna); en ráfagas, asignación por lotes
+    if LOTE_DESPACHO is not None:
+        candidatos = await LOTE_DESPACHO.candidatos(data)
+    else:
+        candidatos = await buscar_candidatos_oferta(data)
+    if not candidatos:
+        # Sin móvil disponible: la solicitud queda en la cola de espera
+        data.update(_marcas_cola(data))
+        service_id = await create_service_async(data)
+        avisar_en_espera(service_id, data)
+        context.user_data.clear()
         return
 
-    movil_chat_id = movil_info["chat_id"]
-    movil_codigo  = movil_info["codigo"]
-
-    data["movil_codigo"]  = movil_codigo
-    data["movil_chat_id"] = movil_chat_id
-    services[service_id]  = data
-    save_services(services)
+    # ID único desde la secuencia de la BD (atómico aunque lleguen solicitudes simultáneas)
+    service_id = await create_service_async(data)
 
     await update.message.reply_text(
         "✅ Tu solicitud ha sido registrada.\n"
-        "Estamos notificando a un móvil cercano para que tome tu servicio."
+        "Estamos notificando a los móviles cercanos para que tomen tu servicio."
     )
 
-    # Mensaje al móvil
-    texto_movil  = f"🚨 *Nuevo servicio de {nombre_srv}*\n\n"
-    texto_movil += f"🆔 Código de servicio: *{service_id}*\n"
-    texto_movil += f"👤 Cliente: *{data.get('nombre', '(sin nombre)')}*\n"
-    texto_movil += f"📞 Teléfono cliente: *{data.get('telefono', '(sin teléfono)')}*\n"
-    texto_movil += f"📍 Destino: *{data.get('destino', '(sin destino)')}*\n"
-    if clave_servicio == "camionetas":
-        texto_movil += f"📦 Tipo de carga: *{data.get('carga', '(no especificada)')}*\n"
-    if data.get("lat") is not None and data.get("lon") is not None:
-        texto_movil += "\n🌎 El cliente compartió ubicación GPS.\n"
-    texto_movil += f"\n⏰ Hora: *{hora}* (Colombia)\n\nPresiona el botón para tomar el servicio."
+    # La entrega de las ofertas espera turno en la cola de salida: va en segundo plano para
+    # no retener el candado del chat (el servicio ya quedó guardado)
+    en_fondo(ofertar_nuevo_servicio(context, service_id, data, candidatos))
+    context.user_data.clear()
 
-    keyboard = InlineKeyboardMarkup(
-        [[InlineKeyboardButton("🚨🔴 RESERVAR SERVICIO 🔴🚨", callback_data=f"RESERVAR|{service_id}")]]
-    )
 
+async def ofertar_nuevo_servicio(context, service_id: str, data: dict, candidatos: list[dict]):
+    """Ofrece un servicio recién creado y publica su resumen en el canal (o lo anuncia en espera)."""
     try:
-        await context.bot.send_message(
-            chat_id=movil_chat_id,
-            text=texto_movil,
-            reply_markup=keyboard,
-            parse_mode="Markdown",
-        )
-    except Exception:
-        await update.message.reply_text("Problema al notificar al móvil. Intenta de nuevo.")
+        entregadas = await ofertar_servicio(context, service_id, data, candidatos)
+    except Exception as e:
+        # El servicio sigue pendiente con `oferta_vence`: revisar_cola lo pasará de ronda
+        print(f"[OFERTA] {service_id}: error ofreciendo el servicio nuevo: {e}")
         return
+    if not entregadas:
+        # Ningún móvil recibió la oferta: ofertar_servicio la dejó en la cola de espera
+        avisar_en_espera(service_id, data)
+        return
+    data["ofertas"] = entregadas
 
-    # Publicar resumen en el canal del servicio
-    canal_id = get_canal(clave_servicio)
+    # Publicar resumen en el canal del servicio (los cambios de estado editan este mensaje)
+    clave = normalizar_servicio(data.get("servicio", "")) or ""
     resumen_canal = (
-        f"📢 *Nuevo servicio de {nombre_srv}*\n"
+        f"📢 *Nuevo servicio de {get_nombre_corto(clave) if clave else '?'}*\n"
         f"🆔 Servicio: *{service_id}*\n"
         f"👤 Cliente: *{data.get('nombre','')}*\n"
         f"📞 Tel: *{data.get('telefono','')}*\n"
         f"📍 Destino: *{data.get('destino','')}*\n"
-        f"🕒 Hora: *{hora}* (Colombia)\n"
-        f"🚗 Móvil asignado: *{movil_codigo}* (en espera de reserva)"
+        f"🕒 Hora: *{data.get('hora','')}* (Colombia)\n"
+        f"🚗 Ofrecido a: *{_codigos_ofertados(data)}* (en espera de reserva)"
     )
-    if canal_id:
-        try:
-            await context.bot.send_message(chat_id=canal_id, text=resumen_canal, parse_mode="Markdown")
-        except Exception:
-            pass
-
-    context.user_data.clear()
+    publicar_en_canal(service_id, data, resumen_canal)
 
 
 # ============================================================
@@ -746,8 +3185,7 @@ async def handle_operador_option(update: Update, context: ContextTypes.DEFAULT_T
 
 async def handle_movil_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     user_id_str = str(update.effective_user.id)
-    mobiles     = get_mobiles()
-    m           = mobiles.get(user_id_str)
+    m           = await get_mobile_async(user_id_str)
 
     if not m:
         await update.message.reply_text(
@@ -766,12 +3204,11 @@ async def handle_movil_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         if not puede:
             await update.message.reply_text("⛔ " + msg, reply_markup=build_movil_keyboard())
             return
-        m["activo"] = True
         # Actualizar clave normalizada en el registro si era nombre viejo
+        cambios = {"activo": True}
         if clave_servicio:
-            m["servicio"] = clave_servicio
-        mobiles[user_id_str] = m
-        save_mobiles(mobiles)
+            cambios["servicio"] = clave_servicio
+        await update_mobile_async(user_id_str, **cambios)
         link    = get_link(clave_servicio) if clave_servicio else None
         mensaje = f"✅ Jornada iniciada para el móvil *{codigo}* ({nombre_srv}).\n\n"
         if link:
@@ -779,6 +3216,7 @@ async def handle_movil_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         else:
             mensaje += "El administrador te indicará el canal de servicios."
         await update.message.reply_text(mensaje, parse_mode="Markdown", reply_markup=build_movil_keyboard())
+        await despachar_cola_para_movil(context, user_id_str)
         return
 
     if text == "📍 Compartir ubicación":
@@ -801,9 +3239,7 @@ async def handle_movil_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
 
     if text == "🛑 Finalizar jornada":
-        m["activo"] = False
-        mobiles[user_id_str] = m
-        save_mobiles(mobiles)
+        await update_mobile_async(user_id_str, activo=False)
         await update.message.reply_text(
             "🛑 Has finalizado tu jornada. Ya no recibirás servicios hasta que vuelvas a iniciar.",
             reply_markup=build_movil_keyboard(),
@@ -837,7 +3273,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     # --- Ver móviles ---
     if text == "🚗 Ver móviles registrados":
-        mobiles = get_mobiles()
+        mobiles = await get_mobiles_async()
         if not mobiles:
             await update.message.reply_text("No hay móviles registrados todavía.")
             return
@@ -856,7 +3292,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     # --- Eliminar móvil ---
     if text == "🗑 Eliminar móvil":
-        mobiles = get_mobiles()
+        mobiles = await get_mobiles_async()
         if not mobiles:
             await update.message.reply_text("No hay móviles registrados.")
             return
@@ -887,8 +3323,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     # --- Ver servicios activos ---
     if text == "📋 Ver servicios activos":
-        services = get_services()
-        activos  = [s for s in services.values() if s.get("status") in ["pendiente", "reservado"]]
+        activos = await servicios_activos_async()
         if not activos:
             await update.message.reply_text("No hay servicios activos en este momento.")
             return
@@ -899,11 +3334,20 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
             lines.append(
                 f"• {s.get('id','')} – {nombre} – {s.get('nombre','')} "
                 f"– Destino: {s.get('destino','')} – Estado: {s.get('status','')} "
-                f"– Móvil: {s.get('movil_codigo','Sin móvil')}"
+                f"– Móvil: {s.get('movil_codigo') or _codigos_ofertados(s) or 'Sin móvil'}"
             )
         await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
         return
 
+    # --- Móviles cercanos a un servicio ---
+    if text == "📍 Móviles cercanos a un servicio":
+        context.user_data["admin_step"] = "cercanos_servicio"
+        await update.message.reply_text(
+            "Escribe el *ID del servicio* (ej: S00012):",
+            parse_mode="Markdown",
+        )
+        return
+
     # --- Flujos de registro por pasos ---
 
     if admin_step == "reg_name":
@@ -977,53 +3421,60 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     if admin_step == "eliminar_movil":
         codigo_ingresado = text.strip().upper()
-        mobiles = get_mobiles()
-        target  = None
-        for cid, m in mobiles.items():
-            if m.get("codigo", "").upper() == codigo_ingresado:
-                target = cid
-                break
-        if not target:
+        encontrado = await get_mobile_por_codigo_async(codigo_ingresado)
+        if not encontrado:
             await update.message.reply_text("❌ No encontré un móvil con ese código.")
             return
-        nombre = mobiles[target].get("nombre", "")
-        del mobiles[target]
-        save_mobiles(mobiles)
-        delete_mobile(target)
+        target, m = encontrado
+        nombre = m.get("nombre", "")
+        await delete_mobile_async(target)
         context.user_data["admin_step"] = None
         await update.message.reply_text(f"🗑 Móvil *{nombre}* ({codigo_ingresado}) eliminado.", parse_mode="Markdown")
         return
 
     if admin_step == "deactivate_code":
-        codigo  = text.strip().upper()
-        mobiles = get_mobiles()
-        target  = None
-        for cid, m in mobiles.items():
-            if m.get("codigo", "").upper() == codigo:
-                target = cid
-                break
-        if not target:
+        codigo     = text.strip().upper()
+        encontrado = await get_mobile_por_codigo_async(codigo)
+        if not encontrado:
             await update.message.reply_text("No encontré un móvil con ese código.")
             return
-        mobiles[target]["activo"] = False
-        save_mobiles(mobiles)
+        target = encontrado[0]
+        await update_mobile_async(target, activo=False)
         context.user_data["admin_step"] = None
         await update.message.reply_text(f"🛑 El móvil *{codigo}* ha sido desactivado.", parse_mode="Markdown")
         return
 
+    if admin_step == "cercanos_servicio":
+        service_id    = text.strip().upper()
+        servicio_data = await get_service_async(service_id)
+        context.user_data["admin_step"] = None
+        if not servicio_data:
+            await update.message.reply_text("No encontré un servicio con ese ID.")
+            return
+        clave = normalizar_servicio(servicio_data.get("servicio", ""))
+        if servicio_data.get("lat") is None or servicio_data.get("lon") is None:
+            await update.message.reply_text("Ese servicio no tiene ubicación GPS del cliente.")
+            return
+        cercanos = await seleccionar_moviles_cercanos_async(
+            clave, servicio_data["lat"], servicio_data["lon"], k=ADMIN_CERCANOS_K
+        ) if clave else []
+        if not cercanos:
+            await update.message.reply_text("No hay móviles activos disponibles para ese servicio.")
+            return
+        lines = [f"📍 *Móviles más cercanos a {service_id}:*\n"]
+        for c in cercanos:
+            dist = f"{c['distancia']:.1f} km" if math.isfinite(c["distancia"]) else "sin GPS"
+            lines.append(f"• {c['codigo']} – {dist}")
+        await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+        return
+
     if admin_step == "approve_payment_code":
-        codigo  = text.strip().upper()
-        mobiles = get_mobiles()
-        target      = None
-        target_data = None
-        for cid, m in mobiles.items():
-            if m.get("codigo", "").upper() == codigo:
-                target      = cid
-                target_data = m
-                break
-        if not target:
+        codigo     = text.strip().upper()
+        encontrado = await get_mobile_por_codigo_async(codigo)
+        if not encontrado:
             await update.message.reply_text("No encontré un móvil con ese código.")
             return
+        target, target_data = encontrado
 
         context.user_data["pending_payment_code"] = codigo
         pago  = "💰 Pago OK" if target_data.get("pago_aprobado") else "💸 Pendiente"
@@ -1071,9 +3522,8 @@ async def _finalizar_registro_movil(
         context.user_data["admin_step"] = None
         return
 
-    codigo  = asignar_codigo_movil(clave_servicio)
-    mobiles = get_mobiles()
-    mobiles[str(chat_id_movil)] = {
+    codigo = await asignar_codigo_movil_async(clave_servicio)
+    await save_mobile_async(str(chat_id_movil), {
         "codigo":        codigo,
         "servicio":      clave_servicio,   # ← SIEMPRE clave interna
         "lat":           None,
@@ -1085,8 +3535,7 @@ async def _finalizar_registro_movil(
         "marca":         reg.get("marca", ""),
         "modelo":        reg.get("modelo", ""),
         "pago_aprobado": False,
-    }
-    save_mobiles(mobiles)
+    })
 
     context.user_data["admin_step"] = None
     context.user_data["reg_movil"]  = {}
@@ -1110,7 +3559,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query   = update.callback_query
     await query.answer()
     data    = query.data
-    bot     = context.bot
     user_id = query.from_user.id
 
     # ── VOLVER AL INICIO ──────────────────────────────────────
@@ -1122,21 +3570,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ── SERVICIO COMPLETADO ───────────────────────────────────
     if data.startswith("servicio_completado_"):
         service_id = data.split("_", 3)[2]
-        services   = get_services()
-        if service_id in services:
-            services[service_id]["status"] = "completado"
-            save_services(services)
-            cliente_id = services[service_id].get("user_chat_id")
-            if cliente_id:
-                try:
-                    await bot.send_message(chat_id=cliente_id, text="✅ Tu servicio ha sido completado.")
-                except Exception:
-                    pass
-            for admin_id in ADMIN_IDS:
-                try:
-                    await bot.send_message(chat_id=admin_id, text=f"✅ Servicio {service_id} completado.")
-                except Exception:
-                    pass
+        async with _CANDADOS_SERVICIO.bloquear(service_id):
+            # Solo el móvil que lo tiene reservado puede completarlo, y una sola vez
+            servicio_data = await update_service_async(
+                service_id,
+                si={"status": "reservado", "movil_chat_id": query.message.chat.id},
+                status="completado",
+            )
+        if not servicio_data:
+            await query.edit_message_text("⚠️ Este servicio ya no está a tu cargo.")
+            return
+        cliente_id = servicio_data.get("user_chat_id")
+        if cliente_id:
+            COLA_SALIDA.encolar(cliente_id, "✅ Tu servicio ha sido completado.", PRIORIDAD_CLIENTE)
+        difundir_en_fondo(f"completado {service_id}", ADMIN_IDS, f"✅ Servicio {service_id} completado.")
         await query.edit_message_text("✅ Servicio marcado como completado.")
         return
 
@@ -1144,8 +3591,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("RESERVAR|"):
         service_id    = data.split("|", 1)[1]
         movil_chat_id = query.message.chat.id
-        mobiles       = get_mobiles()
-        mobile        = mobiles.get(str(movil_chat_id))
+        mobile        = await get_mobile_async(str(movil_chat_id))
 
         if mobile:
             puede, msg = mobile_can_work(mobile)
@@ -1158,22 +3604,27 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-        services      = get_services()
-        servicio_data = services.get(service_id)
-        if not servicio_data:
-            await query.edit_message_text("Este servicio ya no está disponible o ha sido eliminado.")
-            return
-        if servicio_data.get("status") == "reservado":
+        async with _CANDADOS_SERVICIO.bloquear(service_id):
+            # Una sola sentencia condicional en la BD: solo gana el primer móvil que toque RESERVAR
+            resultado, servicio_data = await reservar_servicio_async(service_id, movil_chat_id, now_colombia_str())
+        if resultado == RESERVA_TOMADO:
             await query.edit_message_text("Este servicio ya fue tomado por otro móvil.")
             return
-        if servicio_data.get("movil_chat_id") != movil_chat_id:
+        if resultado == RESERVA_NO_OFRECIDO:
             await query.edit_message_text("Este servicio no está asignado a tu móvil.")
             return
+        if resultado == RESERVA_SIN_CUPO:
+            await query.edit_message_text(
+                "⛔ Ya tienes el máximo de servicios en curso. Completa uno antes de reservar otro."
+            )
+            return
+        if resultado != RESERVA_OK:
+            await query.edit_message_text("Este servicio ya no está disponible o ha sido eliminado.")
+            return
 
-        servicio_data["status"]       = "reservado"
-        servicio_data["hora_reserva"] = now_colombia_str()
-        services[service_id]          = servicio_data
-        save_services(services)
+        # Avisar a los demás móviles que recibieron la oferta
+        cancelar_timeout_oferta(context.job_queue, service_id)
+        retirar_ofertas(servicio_data.get("ofertas"), excepto=movil_chat_id)
 
         movil_codigo   = servicio_data.get("movil_codigo")
         clave_servicio = normalizar_servicio(servicio_data.get("servicio", "")) or ""
@@ -1198,21 +3649,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Notificar al cliente
         user_chat_id = servicio_data.get("user_chat_id")
         if user_chat_id:
-            try:
-                await bot.send_message(
-                    chat_id=user_chat_id,
-                    text=(
-                        f"✅ Tu servicio ha sido asignado.\n\n"
-                        f"El móvil *{movil_codigo}* llegará pronto.\n"
-                        "Por favor mantén tu teléfono disponible."
-                    ),
-                    parse_mode="Markdown",
-                )
-            except Exception:
-                pass
+            COLA_SALIDA.encolar(
+                user_chat_id,
+                f"✅ Tu servicio ha sido asignado.\n\n"
+                f"El móvil *{movil_codigo}* llegará pronto.\n"
+                "Por favor mantén tu teléfono disponible.",
+                PRIORIDAD_CLIENTE,
+                parse_mode="Markdown",
+            )
 
-        # Publicar en canal
-        canal_id = get_canal(clave_servicio)
+        # Actualizar la publicación del canal
         resumen = (
             f"✅ *Servicio reservado*\n"
             f"🆔 Servicio: *{service_id}*\n"
@@ -1222,11 +3668,32 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📍 Destino: *{servicio_data.get('destino','')}*\n"
             f"⏰ Hora reserva: *{servicio_data.get('hora_reserva','')}* (Colombia)"
         )
-        if canal_id:
-            try:
-                await bot.send_message(chat_id=canal_id, text=resumen, parse_mode="Markdown")
-            except Exception:
-                pass
+        publicar_en_canal(service_id, servicio_data, resumen)
+        return
+
+    # ── RECHAZAR OFERTA (móvil) ───────────────────────────────
+    if data.startswith("RECHAZAR|"):
+        service_id    = data.split("|", 1)[1]
+        movil_chat_id = str(query.message.chat.id)
+        async with _CANDADOS_SERVICIO.bloquear(service_id):
+            servicio_data = await get_service_async(service_id)
+            ofertas       = (servicio_data or {}).get("ofertas") or {}
+            if not servicio_data or servicio_data.get("status") != "pendiente" or movil_chat_id not in ofertas:
+                await query.edit_message_text("Esta oferta ya no está vigente.")
+                return
+            ronda       = int(servicio_data.get("ronda") or 0)
+            restantes   = {cid: o for cid, o in ofertas.items() if cid != movil_chat_id}
+            descartados = list(dict.fromkeys([*(servicio_data.get("descartados") or []), movil_chat_id]))
+            actualizado = await update_service_async(
+                service_id,
+                si={"status": "pendiente", "ronda": ronda},
+                ofertas=restantes,
+                descartados=descartados,
+            )
+        await query.edit_message_text(f"❌ Rechazaste el servicio {service_id}.")
+        # Si todos los de la ronda rechazaron, no esperar al vencimiento
+        if actualizado and not restantes:
+            await siguiente_ronda(context, service_id, ronda, "todos rechazaron")
         return
 
     # ── CANCELAR SERVICIO (móvil solicita cancelación) ────────
@@ -1243,32 +3710,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("🚫 No tienes permisos para esta acción.")
             return
 
-        codigo  = data.split("|", 1)[1]
-        mobiles = get_mobiles()
-        target  = None
-        for cid, m in mobiles.items():
-            if m.get("codigo", "").upper() == codigo.upper():
-                target = cid
-                break
-        if not target:
+        codigo     = data.split("|", 1)[1]
+        encontrado = await get_mobile_por_codigo_async(codigo)
+        if not encontrado:
             await query.edit_message_text("No encontré ese móvil. Puede haber sido eliminado.")
             return
+        target = encontrado[0]
 
-        mobiles[target]["pago_aprobado"] = True
-        save_mobiles(mobiles)
+        await update_mobile_async(target, pago_aprobado=True)
         await query.edit_message_text(f"✅ El pago del móvil *{codigo}* ha sido aprobado.", parse_mode="Markdown")
 
-        try:
-            await bot.send_message(
-                chat_id=int(target),
-                text=(
-                    "💰 Tu pago ha sido *aprobado*.\n\n"
-                    "Ya puedes iniciar jornada y recibir servicios, incluso después de las 3:00 p.m."
-                ),
-                parse_mode="Markdown",
-            )
-        except Exception:
-            pass
+        COLA_SALIDA.encolar(
+            int(target),
+            "💰 Tu pago ha sido *aprobado*.\n\n"
+            "Ya puedes iniciar jornada y recibir servicios, incluso después de las 3:00 p.m.",
+            PRIORIDAD_CLIENTE,
+            parse_mode="Markdown",
+        )
 
         context.user_data.pop("pending_payment_code", None)
         return
@@ -1326,110 +3784,81 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ── CANCELACIÓN DE SERVICIO (flujo pendiente de móvil) ────
     if "cancelando_servicio" in context.user_data:
+        # Se quita del estado después del candado: si este vence, el usuario reintenta el motivo
         service_id = context.user_data["cancelando_servicio"]
         motivo     = text
-        services   = get_services()
-
-        if service_id in services:
-            servicio_data = services[service_id]
-
-            # Normalizar clave del servicio (compatibilidad con registros viejos)
-            clave_servicio = normalizar_servicio(servicio_data.get("servicio", ""))
-            canal_id       = get_canal(clave_servicio) if clave_servicio else None
-            nombre_srv     = get_nombre_corto(clave_servicio) if clave_servicio else "?"
-            movil_cancelador = servicio_data.get("movil_codigo", "desconocido")
-
-            # Resetear estado del servicio a pendiente
-            servicio_data["motivo_cancelacion"] = motivo
-            servicio_data["cancelado_por"]      = "movil"
-            servicio_data["status"]             = "pendiente"
-            servicio_data["movil_codigo"]       = None
-            servicio_data["movil_chat_id"]      = None
-            save_services(services)
-
-            # 1) Notificar a todos los admins
-            texto_admin = (
-                f"⚠️ *Cancelación de servicio*\n\n"
-                f"🆔 Servicio: *{service_id}*\n"
-                f"🚗 Móvil que canceló: *{movil_cancelador}*\n"
-                f"📍 Destino: {servicio_data.get('destino','')}\n"
-                f"👤 Cliente: {servicio_data.get('nombre','')}\n"
-                f"❌ Motivo: {motivo}\n\n"
-                "El servicio fue vuelto a estado *disponible* y republicado en el canal."
-            )
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=texto_admin,
-                        parse_mode="Markdown",
-                    )
-                except Exception:
-                    pass
-
-            # 2) Republicar en el canal como servicio disponible nuevamente
-            hora_actual = now_colombia_str()
-            texto_canal = (
-                f"🚨 *SERVICIO DISPONIBLE NUEVAMENTE* 🚨\n\n"
-                f"🆔 Servicio: *{service_id}*\n"
-                f"🚗 Tipo: *{nombre_srv}*\n"
-                f"👤 Cliente: {servicio_data.get('nombre','')}\n"
-                f"📞 Tel: {servicio_data.get('telefono','')}\n"
-                f"📍 Destino: {servicio_data.get('destino','')}\n"
-                f"🕒 Hora: *{hora_actual}* (Colombia)\n\n"
-                "⚠️ El móvil anterior canceló. Este servicio necesita un nuevo operador."
-            )
-            if canal_id:
-                try:
-                    await context.bot.send_message(
-                        chat_id=canal_id,
-                        text=texto_canal,
-                        parse_mode="Markdown",
-                    )
-                except Exception:
-                    pass
-
-            # 3) Intentar reasignar automáticamente a otro móvil
-            lat_cliente = servicio_data.get("lat")
-            lon_cliente = servicio_data.get("lon")
-            nuevo_movil = seleccionar_movil_mas_cercano(clave_servicio, lat_cliente, lon_cliente) if clave_servicio else None
-
-            if nuevo_movil:
-                nuevo_chat_id = nuevo_movil["chat_id"]
-                nuevo_codigo  = nuevo_movil["codigo"]
-                servicio_data["movil_codigo"]  = nuevo_codigo
-                servicio_data["movil_chat_id"] = nuevo_chat_id
-                servicio_data["status"]        = "pendiente"
-                save_services(services)
-
-                hora_reasig = now_colombia_str()
-                texto_movil  = f"🚨 *Nuevo servicio de {nombre_srv}*\n\n"
-                texto_movil += f"🆔 Código de servicio: *{service_id}*\n"
-                texto_movil += f"👤 Cliente: *{servicio_data.get('nombre', '(sin nombre)')}*\n"
-                texto_movil += f"📞 Teléfono cliente: *{servicio_data.get('telefono', '(sin teléfono)')}*\n"
-                texto_movil += f"📍 Destino: *{servicio_data.get('destino', '(sin destino)')}*\n"
-                if clave_servicio == "camionetas":
-                    texto_movil += f"📦 Tipo de carga: *{servicio_data.get('carga', '(no especificada)')}*\n"
-                texto_movil += f"\n⏰ Hora: *{hora_reasig}* (Colombia)\n\nPresiona el botón para tomar el servicio."
-
-                keyboard = InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🚨🔴 RESERVAR SERVICIO 🔴🚨", callback_data=f"RESERVAR|{service_id}")]]
+        chat_id    = update.effective_chat.id
+        async with _CANDADOS_SERVICIO.bloquear(service_id):
+            servicio_data = await get_service_async(service_id)
+            previo        = servicio_data or {}
+            descartados   = list(dict.fromkeys([*(previo.get("descartados") or []), str(chat_id)]))
+            # Resetear estado del servicio a pendiente (solo si sigue reservado a este móvil:
+            # un mensaje viejo no puede soltar la reserva de otro)
+            if servicio_data:
+                servicio_data = await update_service_async(
+                    service_id,
+                    si={"status": "reservado", "movil_chat_id": chat_id},
+                    motivo_cancelacion=motivo,
+                    cancelado_por="movil",
+                    status="pendiente",
+                    movil_codigo=None,
+                    movil_chat_id=None,
+                    ofertas={},
+                    oferta_vence=_vence_oferta(),
+                    descartados=descartados,
                 )
-                try:
-                    await context.bot.send_message(
-                        chat_id=nuevo_chat_id,
-                        text=texto_movil,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown",
-                    )
-                except Exception:
-                    pass
+        context.user_data.pop("cancelando_servicio", None)
+
+        if not servicio_data:
+            await update.message.reply_text(
+                "⚠️ Este servicio ya no está reservado a tu nombre.",
+                reply_markup=build_movil_keyboard(),
+            )
+            return
+
+        # Normalizar clave del servicio (compatibilidad con registros viejos)
+        clave_servicio   = normalizar_servicio(servicio_data.get("servicio", ""))
+        nombre_srv       = get_nombre_corto(clave_servicio) if clave_servicio else "?"
+        movil_cancelador = previo.get("movil_codigo", "desconocido")
+
+        # 1) Notificar a todos los admins
+        texto_admin = (
+            f"⚠️ *Cancelación de servicio*\n\n"
+            f"🆔 Servicio: *{service_id}*\n"
+            f"🚗 Móvil que canceló: *{movil_cancelador}*\n"
+            f"📍 Destino: {servicio_data.get('destino','')}\n"
+            f"👤 Cliente: {servicio_data.get('nombre','')}\n"
+            f"❌ Motivo: {motivo}\n\n"
+            "El servicio fue vuelto a estado *disponible* y actualizado en el canal."
+        )
+        difundir_en_fondo(f"cancelación {service_id}", ADMIN_IDS, texto_admin, parse_mode="Markdown")
+
+        # 2) Marcar en el canal el servicio como disponible nuevamente
+        hora_actual = now_colombia_str()
+        texto_canal = (
+            f"🚨 *SERVICIO DISPONIBLE NUEVAMENTE* 🚨\n\n"
+            f"🆔 Servicio: *{service_id}*\n"
+            f"🚗 Tipo: *{nombre_srv}*\n"
+            f"👤 Cliente: {servicio_data.get('nombre','')}\n"
+            f"📞 Tel: {servicio_data.get('telefono','')}\n"
+            f"📍 Destino: {servicio_data.get('destino','')}\n"
+            f"🕒 Hora: *{hora_actual}* (Colombia)\n\n"
+            "⚠️ El móvil anterior canceló. Este servicio necesita un nuevo operador."
+        )
+        publicar_en_canal(service_id, servicio_data, texto_canal)
 
-        del context.user_data["cancelando_servicio"]
         await update.message.reply_text(
             "✅ Cancelación registrada. El servicio volvió a estar disponible.",
             reply_markup=build_movil_keyboard(),
         )
+
+        # 3) Intentar reasignar automáticamente a otros móviles (sin el que canceló),
+        #    ya fuera del candado: la oferta espera la entrega por la cola de salida
+        candidatos = await buscar_candidatos_oferta(servicio_data, excluir=descartados)
+        if candidatos:
+            await ofertar_servicio(context, service_id, servicio_data, candidatos)
+        else:
+            await devolver_a_cola(service_id, servicio_data)
         return
 
     # ── SELECCIÓN DE ROL ──────────────────────────────────────
@@ -1457,8 +3886,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if step == "ask_code":
             codigo_ingresado = text.upper()
             user_id_str      = str(user_id)
-            mobiles          = get_mobiles()
-            m = mobiles.get(user_id_str)
+            m                = await get_mobile_async(user_id_str)
 
             if not m:
                 await update.message.reply_text(
@@ -1483,8 +3911,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             clave = normalizar_servicio(m.get("servicio", ""))
             if clave and m.get("servicio") != clave:
                 m["servicio"] = clave
-                mobiles[user_id_str] = m
-                save_mobiles(mobiles)
+                await update_mobile_async(user_id_str, servicio=clave)
 
             context.user_data["mode"]           = "movil"
             context.user_data["movil_codigo"]   = codigo_real
@@ -1614,18 +4041,13 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Móvil actualizando su ubicación
-    mobiles = get_mobiles()
-    if user_id_str in mobiles:
-        m        = mobiles[user_id_str]
-        m["lat"] = loc.latitude
-        m["lon"] = loc.longitude
-        mobiles[user_id_str] = m
-        save_mobiles(mobiles)
+    # Móvil actualizando su ubicación (solo lat/lon de su fila; False si no está registrado)
+    if await update_mobile_async(user_id_str, lat=loc.latitude, lon=loc.longitude):
         await update.message.reply_text(
             "✅ Ubicación registrada. PRONTO usará esta ubicación para asignarte servicios cercanos.",
             reply_markup=build_movil_keyboard(),
         )
+        await despachar_cola_para_movil(context, user_id_str)
         return
 
     await update.message.reply_text(
@@ -1642,7 +4064,7 @@ async def cmd_exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     try:
-        mobiles = get_mobiles()
+        mobiles = await get_mobiles_async()
         contenido = json.dumps(mobiles, ensure_ascii=False, indent=2)
         await update.message.reply_document(
             document=contenido.encode("utf-8"),
@@ -1652,26 +4074,308 @@ async def cmd_exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {e}")
 
+
+async def cmd_estado(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra métricas internas (pool, caché de móviles, cola de salida y despacho por lotes)."""
+    if not is_admin(update.effective_user.id):
+        return
+    st = DB_POOL.stats()
+    await update.message.reply_text(
+        "📊 Estado del pool PostgreSQL\n\n"
+        f"En uso: {st['en_uso']} / {st['maximo']}\n"
+        f"Libres: {st['libres']}\n"
+        f"En espera: {st['esperando']}\n"
+        f"Préstamos: {st['prestamos']}\n"
+        f"Latencia préstamo: media {st['latencia_media_ms']:.1f} ms – máx {st['latencia_max_ms']:.1f} ms\n"
+        f"Reconexiones: {st['reconexiones']} – Timeouts: {st['timeouts']}"
+    )
+    mc = CACHE_MOVILES.metricas
+    await update.message.reply_text(
+        "🚗 Caché de móviles\n\n"
+        f"Aciertos: {mc['aciertos']} – Fallos: {mc['fallos']} – Recargas: {mc['recargas']}\n"
+        f"Avisos de otros procesos: {OYENTE_CAMBIOS.metricas['avisos']} – "
+        f"Reconexiones: {OYENTE_CAMBIOS.metricas['reconexiones']}"
+    )
+    ms = COLA_SALIDA.metricas
+    await update.message.reply_text(
+        "📤 Cola de salida\n\n"
+        f"Pendientes: {COLA_SALIDA.pendientes()}\n"
+        f"Enviados: {ms['enviados']} – Fallidos: {ms['fallidos']}\n"
+        f"Reintentos: {ms['reintentos']} – RetryAfter: {ms['retry_after']}\n"
+        f"Apartados por límite de chat: {ms['diferidos']}"
+    )
+    if LOTE_DESPACHO is not None:
+        ml = METRICAS_LOTE
+        ahorro = ml["km_voraz"] - ml["km_optimo"]
+        await update.message.reply_text(
+            f"🧮 Despacho por lotes ({DESPACHO_LOTE_MS:g} ms)\n\n"
+            f"Lotes: {ml['lotes']} – Solicitudes: {ml['solicitudes']}\n"
+            f"Asignadas: {ml['asignadas']} (voraz: {ml['asignadas_voraz']})\n"
+            f"Km de recogida: {ml['km_optimo']:.1f} (voraz: {ml['km_voraz']:.1f}, ahorro {ahorro:.1f})\n"
+            f"Lotes resueltos con voraz por tamaño: {ml['voraz_forzado']}"
+        )
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Errores que escapan de un handler o job. Si el servicio quedó bloqueado por otro proceso
+    más de BLOQUEO_TIMEOUT_S (CandadoOcupado), se le avisa al usuario para que reintente.
+    """
+    error = context.error
+    if isinstance(error, CandadoOcupado):
+        print(f"[CANDADOS] {error}")
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat:
+            COLA_SALIDA.encolar(
+                chat.id,
+                "⏳ Ese servicio se está actualizando en este momento. Intenta de nuevo en unos segundos.",
+                PRIORIDAD_CLIENTE,
+            )
+        return
+    print(f"[ERROR] {''.join(traceback.format_exception(type(error), error, error.__traceback__))}")
+
+
+async def iniciar_servicios(application):
+    """post_init: tareas de fondo que viven en el loop del bot."""
+    COLA_SALIDA.iniciar(application.bot)
+    if CAMBIOS_NOTIFY:
+        await OYENTE_CAMBIOS.iniciar(application)
+
+
+async def detener_servicios(application):
+    """post_shutdown: detiene las tareas de fondo."""
+    await OYENTE_CAMBIOS.detener()
+    await COLA_SALIDA.detener()
+
+
+# --- Varios workers: router, worker y cluster ---
+
+def clave_de_ruta(datos: dict) -> int:
+    """chat_id del update crudo (o el id del usuario si no trae chat); 0 si no tiene ninguno."""
+    for campo, valor in datos.items():
+        if campo == "update_id" or not isinstance(valor, dict):
+            continue
+        chat = valor.get("chat") or (valor.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        usuario = valor.get("from") or valor.get("user")
+        if usuario:
+            return usuario["id"]
+    return 0
+
+
+class _WebhookRouter(tornado.web.RequestHandler):
+    """Recibe el webhook de Telegram y reenvía el update crudo al worker de su chat."""
+
+    def initialize(self, cliente: httpx.AsyncClient, workers: list):
+        self.cliente = cliente
+        self.workers = workers
+
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            raise tornado.web.HTTPError(403)
+        try:
+            clave = clave_de_ruta(json.loads(self.request.body))
+        except (ValueError, TypeError, KeyError):
+            raise tornado.web.HTTPError(400)
+        destino = self.workers[abs(clave) % len(self.workers)]
+        try:
+            r = await self.cliente.post(
+                destino + "/update",
+                content=self.request.body,
+                headers={"Content-Type": "application/json", "X-Pronto-Worker-Secret": WORKER_SECRET or ""},
+            )
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            # 503 → Telegram reintenta el mismo update más tarde
+            print(f"[ROUTER] No se pudo reenviar a {destino}: {e}")
+            raise tornado.web.HTTPError(503)
+        self.set_status(200)
+
+
+class _WorkerUpdates(tornado.web.RequestHandler):
+    """Recibe en el worker los updates reenviados por el router y los mete en la cola del bot."""
+
+    def initialize(self, aplicacion):
+        self.aplicacion = aplicacion
+
+    async def post(self):
+        if WORKER_SECRET and self.request.headers.get("X-Pronto-Worker-Secret") != WORKER_SECRET:
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.aplicacion.bot)
+        except (ValueError, TypeError, KeyError):
+            raise tornado.web.HTTPError(400)
+        await self.aplicacion.update_queue.put(update)
+        self.set_status(200)
+
+
+async def _esperar_senal():
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, parar.set)
+    await parar.wait()
+
+
+async def servir_worker(application):
+    """BOT_MODE=worker: ciclo de vida del bot a mano, con los updates entrando por HTTP."""
+    await application.initialize()
+    await iniciar_servicios(application)
+    await application.start()
+    servidor = HTTPServer(tornado.web.Application([(r"/update", _WorkerUpdates, {"aplicacion": application})]))
+    servidor.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    print(f"[WORKER {WORKER_INDICE}/{WORKERS_TOTAL}] Atendiendo updates en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/update")
+    try:
+        await _esperar_senal()
+    finally:
+        servidor.stop()
+        await application.stop()
+        await application.shutdown()
+        await detener_servicios(application)
+
+
+def _lanzar_worker(indice: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_MODE="worker",
+        WORKER_INDICE=str(indice),
+        WORKERS=str(WORKERS_TOTAL),
+        PORT=str(WORKERS_PUERTO_BASE + indice),
+        WEBHOOK_LISTEN="127.0.0.1",
+    )
+    if WORKER_SECRET:
+        env["WORKER_SECRET"] = WORKER_SECRET
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+
+async def _vigilar_workers(procesos: list):
+    """Relanza los workers hijos que se caen (cada hijo conserva su índice y puerto)."""
+    while True:
+        await asyncio.sleep(2)
+        for i, p in enumerate(procesos):
+            if p.poll() is not None:
+                print(f"[CLUSTER] Worker {i} terminó (código {p.returncode}); relanzando.")
+                procesos[i] = _lanzar_worker(i)
+
+
+async def enrutar():
+    """
+    BOT_MODE=router | cluster: registra el webhook y reenvía cada update a un worker según su
+    chat_id, de modo que un mismo chat siempre lo atiende el mismo proceso. En cluster, además,
+    lanza y vigila WORKERS procesos hijos en 127.0.0.1:WORKERS_PUERTO_BASE+i.
+    """
+    procesos = []
+    vigia = None
+    if BOT_MODE == "cluster":
+        procesos = [_lanzar_worker(i) for i in range(WORKERS_TOTAL)]
+        workers = [f"http://127.0.0.1:{WORKERS_PUERTO_BASE + i}" for i in range(WORKERS_TOTAL)]
+        vigia = asyncio.create_task(_vigilar_workers(procesos))
+    else:
+        workers = WORKER_URLS
+    if not workers:
+        raise RuntimeError("BOT_MODE=router necesita WORKER_URLS")
+
+    bot = Bot(TOKEN, base_url=TELEGRAM_API_URL) if TELEGRAM_API_URL else Bot(TOKEN)
+    async with bot, httpx.AsyncClient(timeout=WORKER_TIMEOUT_S) as cliente:
+        servidor = HTTPServer(tornado.web.Application([
+            (WEBHOOK_PATH, _WebhookRouter, {"cliente": cliente, "workers": workers}),
+        ]))
+        servidor.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONN,
+            drop_pending_updates=True,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        print(f"[ROUTER] Webhook en {WEBHOOK_LISTEN}:{WEBHOOK_PORT} → {len(workers)} workers")
+        try:
+            await _esperar_senal()
+        finally:
+            servidor.stop()
+            if vigia is not None:
+                vigia.cancel()
+            for p in procesos:
+                p.terminate()
+            for p in procesos:
+                try:
+                    p.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+
+
 def main():
+    if BOT_MODE in ("router", "cluster"):
+        # El router no toca la base de datos: solo reparte updates
+        asyncio.run(enrutar())
+        return
+    if BOT_MODE == "worker" and not ({"WORKER_INDICE", "WORKERS"} <= os.environ.keys()):
+        # Sin índice explícito todos serían el 0 y correrían las tareas de mantenimiento, y
+        # sin WORKERS > 1 no activarían los candados distribuidos
+        raise RuntimeError("BOT_MODE=worker necesita WORKER_INDICE y WORKERS (el cluster los pone solo)")
+    if BOT_MODE == "worker" and not 0 <= WORKER_INDICE < WORKERS_TOTAL:
+        raise RuntimeError(f"WORKER_INDICE={WORKER_INDICE} fuera de rango para WORKERS={WORKERS_TOTAL}")
+    DB_POOL.abrir()
     init_db()  # Verificar/crear tablas al arrancar
-    application = (
+    recargar_mobiles()  # Caché de móviles + índice espacial de los activos
+    builder = (
         ApplicationBuilder()
         .token(TOKEN)
-        .concurrent_updates(False)
-        .build()
+        .concurrent_updates(ProcesadorPorChat(MAX_CONCURRENT_UPDATES))
+        .post_init(iniciar_servicios)
+        .post_shutdown(detener_servicios)
     )
+    if ESTADO_COMPARTIDO:
+        builder = builder.persistence(PersistenciaPostgres())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+
+    if application.job_queue is not None:
+        # Cada proceso tiene su propia caché de móviles
+        application.job_queue.run_repeating(
+            recargar_mobiles_job, interval=MOVILES_CACHE_TTL_S, first=MOVILES_CACHE_TTL_S
+        )
+    # Con varios workers, las tareas de mantenimiento corren solo en el worker 0
+    if application.job_queue is not None and WORKER_INDICE == 0:
+        application.job_queue.run_repeating(revisar_cola, interval=COLA_REVISION_S, first=COLA_REVISION_S)
+        application.job_queue.run_repeating(archivar_job, interval=ARCHIVO_INTERVALO_H * 3600, first=60)
 
     application.add_handler(CommandHandler("start",     start))
     application.add_handler(CommandHandler("admin",     cmd_admin))
     application.add_handler(CommandHandler("soy_movil", soy_movil_command))
     application.add_handler(CommandHandler("exportar", cmd_exportar))
+    application.add_handler(CommandHandler("estado",   cmd_estado))
 
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.LOCATION, location_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    application.add_error_handler(error_handler)
 
     print("✅ Bot PRONTO v2.0 iniciado correctamente.")
-    application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    try:
+        if BOT_MODE == "worker":
+            asyncio.run(servir_worker(application))
+        elif BOT_MODE == "webhook":
+            print(f"[BOT] Modo webhook en {WEBHOOK_LISTEN}:{WEBHOOK_PORT} → {WEBHOOK_DOMAIN}/webhook/…")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONN,
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            print("[BOT] Modo polling.")
+            application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    finally:
+        _DB_EXECUTOR.shutdown(wait=True)
+        CONEXION_CANDADOS.cerrar()
+        DB_POOL.cerrar_todo()
 
 
 if __name__ == "__main__":